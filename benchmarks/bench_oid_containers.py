@@ -0,0 +1,95 @@
+#!/opt/zenoss/bin/python
+##############################################################################
+#
+# Copyright (C) Zenoss, Inc. 2020, all rights reserved.
+#
+# This content is made available according to terms specified in
+# License.zenoss under the directory where your Zenoss product is installed.
+#
+##############################################################################
+
+""" Memory and build time of zodbscan's OidSet / OidMap against the set of 8-byte oid strings and the dict
+    they replaced. Every measurement runs in its own forked process so RSS deltas don't bleed into each
+    other. Oids are a dense range inserted in shuffled order, like a BFS over a ZODB visits them. """
+
+import argparse
+import multiprocessing
+import random
+import time
+
+from array import array
+from zenoss.toolbox.ZenToolboxUtils import get_rss
+from zenoss.toolbox.zodbscan import OidMap, OidSet
+from ZODB.utils import p64
+
+
+def shuffled_zoids(count, seed=42):
+    zoids = array('L', xrange(1, count + 1))
+    rng = random.Random(seed)
+    for i in xrange(count - 1, 0, -1):
+        j = rng.randint(0, i)
+        zoids[i], zoids[j] = zoids[j], zoids[i]
+    return zoids
+
+
+def build_set(zoids):
+    result = set()
+    for zoid in zoids:
+        result.add(p64(zoid))
+    return result
+
+
+def build_oidset(zoids):
+    result = OidSet()
+    for zoid in zoids:
+        result.add(zoid)
+    return result
+
+
+def build_dict(zoids):
+    result = {}
+    for zoid in zoids:
+        result[p64(zoid)] = zoid - 1
+    return result
+
+
+def build_oidmap(zoids):
+    result = OidMap()
+    for zoid in zoids:
+        result[zoid] = zoid - 1
+    return result
+
+
+BUILDERS = {'set': build_set, 'OidSet': build_oidset, 'dict': build_dict, 'OidMap': build_oidmap}
+
+
+def measure(name, count, results):
+    zoids = shuffled_zoids(count)
+    before = get_rss()
+    started = time.time()
+    container = BUILDERS[name](zoids)
+    results.put((time.time() - started, get_rss() - before, len(container)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-s", "--sizes", action="store", default="1000000,10000000,50000000",
+                        help="Comma separated object counts")
+    parser.add_argument("-c", "--containers", action="store", default="set,OidSet,dict,OidMap",
+                        help="Comma separated containers out of %s" % ', '.join(sorted(BUILDERS)))
+    options = parser.parse_args()
+
+    print("%-8s %12s %10s %12s %10s" % ("", "objects", "seconds", "MB", "bytes/obj"))
+    for count in [int(size) for size in options.sizes.split(',')]:
+        for name in options.containers.split(','):
+            results = multiprocessing.Queue()
+            worker = multiprocessing.Process(target=measure, args=(name, count, results))
+            worker.start()
+            seconds, rss, length = results.get()
+            worker.join()
+            assert length == count
+            print("%-8s %12d %10.1f %12.1f %10.2f" % (name, count, seconds, rss / 1048576.0, float(rss) / count))
+
+
+if __name__ == "__main__":
+    main()
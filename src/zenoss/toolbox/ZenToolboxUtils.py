@@ -10,11 +10,13 @@
 import argparse
 import logging
 import os
+import resource
 import socket
 import sys
 import time
 
-from multiprocessing import Lock, Value
+from collections import OrderedDict
+from multiprocessing import Value
 
 
 def configure_logging(name, version, tmpdir):
@@ -54,6 +56,23 @@ def configure_logging(name, version, tmpdir):
     return toolbox_log, log_file_name
 
 
+def get_state_dir():
+    '''Returns $ZENHOME/var/toolbox (created if missing), where tools keep state between runs'''
+    state_path = os.path.join(os.getenv("ZENHOME"), 'var', 'toolbox')
+    if not os.path.exists(state_path):
+        os.makedirs(state_path)
+    return state_path
+
+
+def get_rss():
+    '''Returns the resident set size of this process in bytes (the peak RSS where /proc is unavailable)'''
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except (IOError, IndexError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
 def get_lock(lock_name, log):
     '''Global lock function to keep multiple tools from running at once'''
     global lock_socket
@@ -77,13 +96,18 @@ def inline_print(message):
 
 
 class Counter(object):
-    def __init__(self, initval=0):
-        self.val = Value('i', initval)
-        self.lock = Lock()
-
-    def increment(self):
+    '''Integer counter in shared memory - safe to update from processes forked after its creation.
+    Increments are also added to total, if given (e.g. a counter summing several worker processes).'''
+    def __init__(self, initval=0, total=None):
+        self.val = Value('l', initval)
+        self.lock = self.val.get_lock()
+        self.total = total
+
+    def increment(self, amount=1):
         with self.lock:
-            self.val.value += 1
+            self.val.value += amount
+        if self.total is not None:
+            self.total.increment(amount)
 
     def value(self):
         with self.lock:
@@ -94,6 +118,33 @@ class Counter(object):
             self.val.value = 0
 
 
+class LRUCache(object):
+    '''Mapping holding at most size entries, dropping the least recently used one when full'''
+    def __init__(self, size):
+        self.size = size
+        self.data = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key, default=None):
+        try:
+            value = self.data.pop(key)
+        except KeyError:
+            return default
+        self.data[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self.data.pop(key, None)
+        self.data[key] = value
+        if len(self.data) > self.size:
+            self.data.popitem(last=False)
+
+
 def parse_options(scriptVersion, description_string):
     """Defines command-line options for script """
     parser = argparse.ArgumentParser(version=scriptVersion, description=description_string)
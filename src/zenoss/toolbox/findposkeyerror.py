@@ -14,18 +14,30 @@ documentationURL = "https://support.zenoss.com/hc/en-us/articles/203117795"
 
 
 import abc
+import anydbm
 import argparse
 import datetime
 import Globals
+import hashlib
+import itertools
+import json
 import logging
+import marshal
+import multiprocessing
 import os
+import Queue
+import random
 import re
 import sys
+import tempfile
+import threading
 import time
 import traceback
 import transaction
 import ZenToolboxUtils
 
+from array import array
+from collections import deque
 from Products.ZenModel.Device import Device
 from Products.ZenModel.ZenStatus import ZenStatus
 from Products.ZenRelations.RelationshipBase import RelationshipBase
@@ -38,12 +50,28 @@ try:
 except ImportError:
     pass
 from ZenToolboxUtils import inline_print
-from ZODB.POSException import POSKeyError
-from ZODB.utils import u64
+try:
+    from pkg_resources import iter_entry_points
+except ImportError:
+    iter_entry_points = None
+from ZODB.POSException import ConflictError, POSKeyError
+from ZODB.utils import p64, u64
 
 
 unused(Globals) 
 
+# Set in worker processes, where commits of the different subtrees must not overlap
+_commit_lock = None
+
+
+def commit():
+    """ Commits the current transaction, one process at a time when scanning with --workers """
+    if _commit_lock is None:
+        transaction.commit()
+        return
+    with _commit_lock:
+        transaction.commit()
+
 
 def progress_bar(items, errors, repairs, fix_value, cycle):
     if fix_value:
@@ -55,13 +83,18 @@ def progress_bar(items, errors, repairs, fix_value, cycle):
 
 
 class Fixer(object):
+    """
+    Fixers beyond the built-in ones below are registered by other distributions
+    under the "zenoss.toolbox.findposkeyerror.fixers" entry point group.
+    """
     __metaclass__ = abc.ABCMeta
 
     @abc.abstractmethod
     def fixable(self, ex, objId, parentPath, dmd, log):
         """
         Return a no-argument callable object that will perform the fix
-        when invoked or None if not fixable.
+        when invoked or None if not fixable.  The fix must not commit -
+        repairs are committed in batches by a RepairQueue.
         """
 
 
@@ -94,7 +127,6 @@ class RelFixer(Fixer):
         cls = relationship._objects.__class__
         relationship._objects = cls()
         parent._p_changed = True
-        transaction.commit()
 
 
 class SearchManagerFixer(Fixer):
@@ -132,13 +164,11 @@ class SearchManagerFixer(Fixer):
             parent._delOb('SearchManager')
         except Exception as e:
             log.exception(e)
-        transaction.commit()
 
         try:
             parent._setObject(SEARCH_MANAGER_ID, SearchManager(SEARCH_MANAGER_ID))
         except Exception as e:
             log.exception(e)
-        transaction.commit()
 
 
 class ComponentSearchFixer(Fixer):
@@ -168,13 +198,11 @@ class ComponentSearchFixer(Fixer):
             parent._delOb('componentSearch')
         except Exception as e:
             log.exception(e)
-        transaction.commit()
 
         try:
             parent._create_componentSearch()
         except Exception as e:
             log.exception(e)
-        transaction.commit()
 
 
 class OperatingSystemFixer(Fixer):
@@ -206,14 +234,12 @@ class OperatingSystemFixer(Fixer):
             parent._delOb('os')
         except Exception as e:
             log.exception(e)
-        transaction.commit()
 
         try:
             temp_os_comp = OperatingSystem()
             parent._setObject(temp_os_comp.id, temp_os_comp)
         except Exception as e:
             log.exception(e)
-        transaction.commit()
 
 
 class HardwareFixer(Fixer):
@@ -245,42 +271,212 @@ class HardwareFixer(Fixer):
             parent._delOb('hw')
         except Exception as e:
             log.exception(e)
-        transaction.commit()
 
         try:
             temp_hw_comp = DeviceHW()
             parent._setObject(temp_hw_comp.id, temp_hw_comp)
         except Exception as e:
             log.exception(e)
-        transaction.commit()
 
 _fixits = [RelFixer(), SearchManagerFixer(), ComponentSearchFixer(), OperatingSystemFixer(), HardwareFixer(), ]
 
+FIXERS_ENTRY_POINT_GROUP = "zenoss.toolbox.findposkeyerror.fixers"
 
-def _getEdges(node, path_string, attempt_fix, counters, log):
-    cls = node.aq_base
+
+def register_fixers(log):
+    """ Adds the fixers registered under FIXERS_ENTRY_POINT_GROUP (Fixer subclasses or instances) to _fixits """
+    if iter_entry_points is None:
+        return
+    for entry_point in iter_entry_points(FIXERS_ENTRY_POINT_GROUP):
+        try:
+            fixer = entry_point.load()
+            if isinstance(fixer, type):
+                fixer = fixer()
+        except Exception as e:
+            log.error("Unable to load fixer %s: %s: %s", entry_point, type(e).__name__, e)
+            continue
+        if not isinstance(fixer, Fixer):
+            log.error("Ignoring fixer %s - not a Fixer", entry_point)
+            continue
+        _fixits.append(fixer)
+        log.info("Registered fixer %s from %s", entry_point.name, entry_point.dist)
+
+
+class RepairQueue(object):
+    """ Applies repairs as they are found, each in its own savepoint so that a failing repair is rolled back alone,
+        and commits them batch_size at a time - logging which repairs went into which commit. Repairs are added
+        to counter only once their commit succeeded. A commit that conflicts with another process (worker
+        processes repairing objects that share a catalog) is aborted and its repairs are applied again on fresh
+        state, up to COMMIT_ATTEMPTS times. """
+    COMMIT_ATTEMPTS = 5
+
+    def __init__(self, batch_size, log, counter=None):
+        self.batch_size = max(batch_size, 1)
+        self.log = log
+        self.counter = counter
+        self.pending = []
+        self.commits = 0
+
+    def _try(self, description, fix):
+        savepoint = transaction.savepoint()
+        try:
+            fix()
+        except Exception as e:
+            savepoint.rollback()
+            self.log.error("Repair of %s failed and was rolled back: %s: %s", description, type(e).__name__, e)
+            return False
+        return True
+
+    def apply(self, description, fix):
+        if not self._try(description, fix):
+            return False
+        self.pending.append((description, fix))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+        return True
+
+    def flush(self):
+        """ Commits the pending repairs - to be called before any transaction.abort() """
+        if not self.pending:
+            return
+        self.commits += 1
+        attempt = 1
+        while True:
+            descriptions = '; '.join(description for description, fix in self.pending)
+            try:
+                commit()
+            except ConflictError as e:
+                transaction.abort()
+                if attempt == self.COMMIT_ATTEMPTS:
+                    self.log.error("Commit %d failed after %d conflicts (%s) - %d repairs not applied: %s",
+                                   self.commits, attempt, e, len(self.pending), descriptions)
+                    break
+                self.log.warning("Commit %d conflicted (%s) - applying its %d repairs again (attempt %d of %d)",
+                                 self.commits, e, len(self.pending), attempt + 1, self.COMMIT_ATTEMPTS)
+                time.sleep(random.uniform(0, 0.1 * 2 ** attempt))
+                attempt += 1
+                self.pending = [(description, fix) for description, fix in self.pending
+                                if self._try(description, fix)]
+                if not self.pending:
+                    break
+            except Exception as e:
+                transaction.abort()
+                self.log.error("Commit %d failed (%s: %s) - %d repairs not applied: %s", self.commits,
+                               type(e).__name__, e, len(self.pending), descriptions)
+                break
+            else:
+                self.log.info("Commit %d: %d repairs - %s", self.commits, len(self.pending), descriptions)
+                if self.counter is not None:
+                    self.counter.increment(len(self.pending))
+                break
+        self.pending = []
+
+
+def _apply(repairs, description, fix, counter):
+    """ Applies a fix through the repair queue, or on its own and committed right away without one (counted in
+        counter once committed). Returns "repaired", or "failed" if the queue had to roll it back. """
+    if repairs is None:
+        fix()
+        commit()
+        counter.increment()
+        return "repaired"
+    return "repaired" if repairs.apply(description, fix) else "failed"
+
+
+class FindingsWriter(object):
+    """ Streams findings to a file as JSON lines. Findings are queued and serialized by a background thread,
+        which appends them in blocks with one write each - so worker processes can share the file. """
+
+    def __init__(self, filename, block=100):
+        self.fd = os.open(filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        self.block = block
+        self.queue = Queue.Queue()
+        self.thread = threading.Thread(target=self._write, name="findings-writer")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, **finding):
+        self.queue.put(finding)
+
+    def _write(self):
+        done = False
+        while not done:
+            findings = [self.queue.get()]
+            while findings[-1] is not None and len(findings) < self.block:
+                try:
+                    findings.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            if findings[-1] is None:
+                findings.pop()
+                done = True
+            data = ''.join(json.dumps(finding, sort_keys=True) + '\n' for finding in findings)
+            while data:
+                data = data[os.write(self.fd, data):]
+
+    def close(self):
+        """ Writes out the queued findings and closes the file """
+        self.queue.put(None)
+        self.thread.join()
+        os.close(self.fd)
+
+
+def _checkSnmpUpTime(node, path_string, attempt_fix, counters, log, repairs=None, found=None):
+    """ Checks (and with attempt_fix, repairs) _lastPollSnmpUpTime of a device. Returns True if it was broken. """
     attempted_fix = False
+    fix_status = None
+    broken = False
 
     # Fixes ZEN-18368: findposkeyerror should detect/fix _lastPollSnmpUpTime
-    if isinstance(node, Device):
+    try:
         try:
-            try:
-                counters['item_count'].increment()
-                test_reference = node._lastPollSnmpUpTime
-                test_results = test_reference.getStatus()
-            #Fixes ZEN-20252: findposkeyerror won't attempt fix on attributeError for getStatus()
-            except (POSKeyError, AttributeError) as fixableException:
-                if attempt_fix:
-                    counters['repair_count'].increment()
-                    attempted_fix = True
-                    node._lastPollSnmpUpTime = ZenStatus(0)
-                    transaction.commit()
-                raise
+            counters['item_count'].increment()
+            test_reference = node._lastPollSnmpUpTime
+            test_results = test_reference.getStatus()
+        #Fixes ZEN-20252: findposkeyerror won't attempt fix on attributeError for getStatus()
+        except (POSKeyError, AttributeError) as fixableException:
+            if attempt_fix:
+                attempted_fix = True
+                fix_status = _apply(repairs, "'_lastPollSnmpUpTime' of %s" % path_string,
+                                    lambda: setattr(node, '_lastPollSnmpUpTime', ZenStatus(0)),
+                                    counters['repair_count'])
+            raise
+    except Exception as e:
+        broken = True
+        counters['error_count'].increment()
+        log.critical("%s: %s on %s '%s' of %s", type(e).__name__, e, "attribute", "_lastPollSnmpUpTime", path_string)
+        if found:
+            found(e, "attribute", "_lastPollSnmpUpTime", path_string, fix_status)
+    if attempted_fix:
+        log.info("Repairing '_lastPollSnmpUpTime' attribute on %s", node)
+    return broken
+
+
+def _checkSnmpUpTimes(devices, attempt_fix, log, counters, found=None, connection=None, repairs=None):
+    """ Checks the _lastPollSnmpUpTime of a batch of devices ((key, path string, device) triples) - loading the
+        attributes together where the connection supports prefetching - and commits all their repairs together
+        (through repairs, if given). Returns the keys of the devices where it was broken. """
+    if attempt_fix and repairs is None:
+        repairs = RepairQueue(sys.maxint, log, counters['repair_count'])
+    if connection is not None and hasattr(connection, 'prefetch'):
+        try:
+            _prefetch(connection, [getattr(device, '_lastPollSnmpUpTime', None)
+                                   for key, path_string, device in devices])
         except Exception as e:
-            counters['error_count'].increment()
-            log.critical("%s: %s on %s '%s' of %s", type(e).__name__, e, "attribute", "_lastPollSnmpUpTime", path_string)
-        if attempted_fix:
-            log.info("Repairing '_lastPollSnmpUpTime' attribute on %s", node)
+            log.debug("Unable to prefetch _lastPollSnmpUpTime of devices: %s: %s", type(e).__name__, e)
+    broken = [key for key, path_string, device in devices
+              if _checkSnmpUpTime(device, path_string, attempt_fix, counters, log, repairs, found)]
+    if repairs:
+        repairs.flush()
+    log.debug("Checked _lastPollSnmpUpTime of %d devices: %d broken", len(devices), len(broken))
+    return broken
+
+
+def _getEdges(node, path_string, attempt_fix, counters, log, repairs=None, found=None, check_uptime=True):
+    cls = node.aq_base
+
+    if check_uptime and isinstance(node, Device):
+        _checkSnmpUpTime(node, path_string, attempt_fix, counters, log, repairs, found)
 
     names = set(node.objectIds() if hasattr(cls, "objectIds") else [])
     relationships = set(
@@ -297,22 +493,207 @@ def _getPathStr(path):
     return "app%s" % ('.'.join(path)) if len(path) > 1 else "app"
 
 
-def fixPOSKeyError(exname, ex, objType, objId, parentPath, dmd, log, counters):
+class PathQueue(object):
+    """ FIFO queue of node paths (tuples of ids below the top node). At most limit paths are held in memory;
+        older paths are spilled to a temporary file in blocks and read back in the same order. """
+
+    def __init__(self, limit=100000):
+        self.limit = limit
+        self.head = deque()  # Oldest paths, popped first
+        self.tail = []  # Newest paths, spilled as one block when full
+        self.spill = None
+        self.read_offset = 0
+        self.spilled = 0  # Paths in the file not read back yet
+
+    def __len__(self):
+        return len(self.head) + self.spilled + len(self.tail)
+
+    def append(self, path):
+        self.tail.append(path)
+        if len(self.tail) >= self.limit:
+            if self.spill is None:
+                self.spill = tempfile.TemporaryFile(prefix="findposkeyerror")
+            self.spill.seek(0, os.SEEK_END)
+            marshal.dump(self.tail, self.spill)
+            self.spilled += len(self.tail)
+            self.tail = []
+
+    def peek(self, n):
+        """ Returns (up to) the next n paths without removing them """
+        return list(itertools.islice(self.head, n))
+
+    def popleft(self):
+        if not self.head:
+            if self.spilled:
+                self.spill.seek(self.read_offset)
+                self.head.extend(marshal.load(self.spill))
+                self.read_offset = self.spill.tell()
+                self.spilled -= len(self.head)
+                if not self.spilled:
+                    self.spill.truncate(0)
+                    self.read_offset = 0
+            else:
+                self.head.extend(self.tail)
+                self.tail = []
+        return self.head.popleft()
+
+
+class MemoryGovernor(object):
+    """ Frees the ZODB connection cache only when the process grows past a memory budget, instead of aborting
+        every PROGRESS_INTERVAL items. The cache decides whether there is anything to free: nothing is done
+        while it holds no more live objects than its target size, as CPython rarely hands freed memory back and
+        RSS alone would stay over the budget after the first minimization. Past that, RSS picks the remedy:
+        past 80% of the budget the cache is trimmed to its target size (cacheGC), past the budget the
+        transaction is aborted and every object is ghostified (cacheMinimize). Where only the peak RSS is known
+        (no /proc) it never drops back, so once over budget the cache is kept near its target size. """
+
+    def __init__(self, connection, budget_mb, log):
+        self.connection = connection
+        self.budget = budget_mb * 1024 * 1024
+        self.log = log
+        self.collections = 0
+        self.minimizations = 0
+
+    def over_target(self):
+        """ True if the connection cache holds more live objects than its target size (or if it can't tell) """
+        cache = getattr(self.connection, '_cache', None)
+        try:
+            return cache.cache_non_ghost_count > cache.cache_size
+        except AttributeError:
+            return True
+
+    def check(self, repairs=None):
+        if not self.over_target():
+            return
+        rss = ZenToolboxUtils.get_rss()
+        if rss > self.budget:
+            if repairs:
+                repairs.flush()
+            transaction.abort()
+            self.connection.cacheMinimize()
+            self.minimizations += 1
+            self.log.debug("RSS %d MB over budget - minimized the connection cache", rss // (1024 * 1024))
+        elif rss > 0.8 * self.budget:
+            self.connection.cacheGC()
+            self.collections += 1
+
+
+class FingerprintStore(object):
+    """ Fingerprints of the subtrees below a node (one per child) that were last scanned without errors, kept
+        between runs in a dbm file under $ZENHOME/var/toolbox. A fingerprint lists the oids of the containers
+        (objects with children) in the subtree, with a digest of their serials at the time. """
+
+    def __init__(self, top_path):
+        filename = "findposkeyerror_%s.db" % hashlib.md5(top_path).hexdigest()[:16]
+        self.filename = os.path.join(ZenToolboxUtils.get_state_dir(), filename)
+        self.db = anydbm.open(self.filename, 'c')
+
+    @staticmethod
+    def key(name):
+        return name.encode('utf-8') if isinstance(name, unicode) else name
+
+    def unchanged(self, name, storage):
+        """ Returns True if no container of the subtree was modified (or removed) since it was fingerprinted """
+        try:
+            digest, oids = marshal.loads(self.db[self.key(name)])
+        except KeyError:
+            return False
+        zoids = array('L', oids)
+        serials = _loadSerials(storage, zoids)
+        if serials is None:
+            return False
+        current = hashlib.md5()
+        for zoid in zoids:
+            oid = p64(zoid)
+            current.update(oid + serials[zoid])
+        return current.digest() == digest
+
+    def update(self, name, zoids, digest):
+        self.db[self.key(name)] = marshal.dumps((digest, zoids.tostring()))
+
+    def discard(self, name):
+        if self.db.has_key(self.key(name)):
+            del self.db[self.key(name)]
+
+    def close(self):
+        self.db.close()
+
+
+def _loadSerials(storage, zoids, chunk_size=1000):
+    """ Returns a dict of u64 oid -> current serial for zoids, or None if any of them no longer exists. On
+        RelStorage the serials are read from object_state chunk_size oids per query, elsewhere object by object. """
+    serials = {}
+    adapter = getattr(storage, '_adapter', None)
+    if adapter is None:
+        try:
+            for zoid in zoids:
+                serials[zoid] = storage.load(p64(zoid), '')[1]
+        except POSKeyError:
+            return None
+        return serials
+    conn, cursor = adapter.connmanager.open()
+    try:
+        for i in xrange(0, len(zoids), chunk_size):
+            cursor.execute("SELECT zoid, tid FROM object_state WHERE zoid IN (%s)" %
+                           ','.join(str(zoid) for zoid in zoids[i:i + chunk_size]))
+            for zoid, tid in cursor.fetchall():
+                serials[zoid] = p64(tid)
+    finally:
+        adapter.connmanager.close(conn, cursor)
+    if len(serials) != len(set(zoids)):
+        return None
+    return serials
+
+
+def _covered(names, targets):
+    """ Whether the node at names lies below a target whose walk reaches it anyway - a target node that failed
+        itself, or a failed child of a target node """
+    for i in xrange(len(names)):
+        children = targets.get(names[:i], ())
+        if children is None or names[i] in children:
+            return True
+    return False
+
+
+def _resolve(topnode, names, parent=None):
+    """ Returns the node at names below topnode, with the (names, node) pair of its parent. Siblings are popped
+        one after another, so passing the previous parent back in saves walking down from topnode each time. """
+    if not names:
+        return topnode, None
+    if parent is None or parent[0] != names[:-1]:
+        node = topnode
+        for name in names[:-1]:
+            node = node._getOb(name)
+        parent = (names[:-1], node)
+    return parent[1]._getOb(names[-1]), parent
+
+
+def _prefetch(connection, objects):
+    """ Loads the states of the ghosts among objects in one storage round trip, where the connection (ZODB 5)
+        and storage support prefetching """
+    oids = [obj._p_oid for obj in objects if getattr(obj, '_p_changed', 0) is None]
+    if oids:
+        connection.prefetch(oids)
+
+
+def fixPOSKeyError(exname, ex, objType, objId, parentPath, dmd, log, counters, repairs=None):
     """
     Fixes POSKeyErrors given:
         Name of exception type object,
         Exception,
         Type of problem object,
         Name (ID) of the object,
-        The path to the parent of the named object
+        The path to the parent of the named object,
+        The RepairQueue that applies the fix (or None to apply and commit it at once)
+    Returns "repaired", "failed" or "unfixable" (no fixer applies).
     """
     # -- verify that the OIDs match
     for fixer in _fixits:
         fix = fixer.fixable(ex, objId, parentPath, dmd, log)
         if fix:
-            counters['repair_count'].increment()
-            fix()
-            break
+            return _apply(repairs, "'%s' of %s (%s)" % (objId, '/'.join(parentPath), type(fixer).__name__), fix,
+                          counters['repair_count'])
+    return "unfixable"
 
 
 def getPOID(obj):
@@ -324,113 +705,400 @@ def getOID(ex):
     return "0x%08x" % int(str(ex), 16)
 
 
-def findPOSKeyErrors(topnode, attempt_fix, use_unlimited_memory, dmd, log, counters, max_cycles):
-    """ Processes issues as they are found, handles progress output, logs to output file """
+def findPOSKeyErrors(topnode, attempt_fix, use_unlimited_memory, dmd, log, counters, max_cycles, skip=(),
+                     memory_budget=0, prefetch_window=0, incremental=False, commit_batch=1, findings_out=None):
+    """ Processes issues as they are found, handles progress output, logs to output file.
+        Children of topnode named in skip are checked but not descended into (they are scanned separately).
+        With a memory_budget (MB), the cache is freed by a MemoryGovernor rather than by regular aborts.
+        With a prefetch_window, the children of each node and the next prefetch_window queued nodes are
+        loaded with one batched storage call before they are touched.
+        With incremental, children of topnode whose subtree was clean last time and whose containers have not
+        been modified since are checked but not descended into; fingerprints are updated at the end.
+        Only the first cycle walks the whole tree - later cycles recheck the nodes where the previous cycle
+        found errors, descending only into the children that failed (and were possibly repaired).
+        Repairs are committed commit_batch at a time. Findings are also appended to findings_out as JSON lines.
+        The _lastPollSnmpUpTime of walked devices is checked in batches, each batch's repairs committed together. """
 
     PROGRESS_INTERVAL = 829  # Prime number near 1000 ending in a 9, used for progress bar
+    DEVICE_BATCH_SIZE = 1000  # Devices whose _lastPollSnmpUpTime is checked (and repaired) together
+
+    governor = MemoryGovernor(topnode._p_jar, memory_budget, log) if memory_budget else None
+
+    connection = getattr(topnode, '_p_jar', None)
+    if prefetch_window and not hasattr(connection, 'prefetch'):
+        log.info("Prefetching is not supported by this ZODB version - loading objects one at a time")
+        prefetch_window = 0
+
+    repairs = RepairQueue(commit_batch, log, counters['repair_count']) if attempt_fix else None
+
+    findings = FindingsWriter(findings_out) if findings_out else None
+
+    def found(e, kind, name, path_string, fix_status=None):
+        """ Streams a finding (also logged) to findings_out """
+        if findings:
+            try:
+                oid = getOID(e) if isinstance(e, POSKeyError) else None
+            except ValueError:
+                oid = None
+            findings.add(time=time.time(), cycle=current_cycle, exception=type(e).__name__, message=str(e),
+                         oid=oid, kind=kind, name=name, path=path_string, fix=fix_status)
+
+    # Devices walked since _lastPollSnmpUpTime was last checked, as (node path, path string, device)
+    devices = []
+    device_repairs = RepairQueue(sys.maxint, log, counters['repair_count']) if attempt_fix else None
+
+    def check_devices():
+        """ Checks _lastPollSnmpUpTime of the devices walked since the last batch, while they are still loaded """
+        if not devices:
+            return
+        if repairs:
+            repairs.flush()  # The batch commits on its own, so the walk's pending repairs must be counted first
+        for names in _checkSnmpUpTimes(devices, attempt_fix, log, counters, found, connection, device_repairs):
+            failed.append((names, None))
+        del devices[:]
+
+    def free_memory():
+        if governor:
+            governor.check(repairs)
+        elif not use_unlimited_memory:
+            check_devices()  # Before the abort turns the walked devices back into ghosts
+            if repairs:
+                repairs.flush()
+            transaction.abort()
+
+    fingerprints = None
+    unchanged = set()
+    if incremental:
+        fingerprints = FingerprintStore("/".join(topnode.getPhysicalPath()))
+        log.info("Skipping unchanged clean subtrees (fingerprints in %s)", fingerprints.filename)
+
+    # Node path -> names of its children that failed (None if the node itself failed) in the previous cycle
+    targets = {}
+
+    def descend(names, name):
+        """ Whether the child name of the node at names is to be traversed """
+        if names in targets and targets[names] is not None:
+            return name in targets[names]
+        if names:
+            return True
+        if name in skip or name in unchanged:
+            return False
+        if fingerprints and fingerprints.unchanged(name, connection.db().storage):
+            log.info("Skipping %s - unchanged since it was last scanned without errors", name)
+            unchanged.add(name)
+            return False
+        return True
 
     current_cycle = 0
     if not attempt_fix:
         max_cycles = 1
     number_of_issues = -1
     number_of_repairs = -1
+    # Subtrees (children of topnode) where errors were found in any cycle, or whose walk raised anything else
+    dirty = set()
+    # Subtree -> oids of its containers and digest of their serials, from the first (full) cycle
+    containers = {}
 
-    while ((current_cycle < max_cycles) and (number_of_issues != 0) and (number_of_repairs != 0)):
-        # Objects that will have their children traversed are stored in 'nodes'
-        print
-        current_cycle += 1
-        log.info("## Beginning cycle %s of %s (potential)", current_cycle, max_cycles)
-        nodes = [topnode]
-        counters['item_count'].reset()
-        counters['error_count'].reset()
-        counters['repair_count'].reset()
-        while nodes:
-            node = nodes.pop(0)
-            counters['item_count'].increment()
-            path = node.getPhysicalPath()
-            path_string = "/".join(path)
-
-            if (counters['item_count'].value() % PROGRESS_INTERVAL) == 0:
-                if not use_unlimited_memory:
-                    transaction.abort()
-                progress_bar(counters['item_count'].value(), counters['error_count'].value(),
-                             counters['repair_count'].value(), attempt_fix, current_cycle)
-
-            try:
-                attributes, relationships = _getEdges(node, path_string, attempt_fix, counters, log)
-            except _RELEVANT_EXCEPTIONS as e:
-                log.critical("%s: %s %s '%s'", type(e).__name__, e, "while retreiving children of", path_string)
-                counters['error_count'].increment()
-                if attempt_fix:
-                    if isinstance(e, POSKeyError):
-                        fixPOSKeyError(type(e).__name__, e, "node", name, path, dmd, log, counters)
-                continue
-            except Exception as e:
-                log.exception(e)
-
-            for name in relationships:
+    try:
+        while ((current_cycle < max_cycles) and (number_of_issues != 0) and (number_of_repairs != 0)):
+            # Objects that will have their children traversed are stored in 'nodes' - as paths below topnode,
+            # so that the queue holds no persistent objects; each node is resolved again when popped
+            print
+            current_cycle += 1
+            log.info("## Beginning cycle %s of %s (potential)", current_cycle, max_cycles)
+            nodes = PathQueue()
+            if current_cycle == 1:
+                nodes.append(())
+            else:
+                for names in sorted(targets):
+                    if not _covered(names, targets):
+                        nodes.append(names)
+                log.info("Cycle %s rechecks %d paths where errors were found in cycle %s", current_cycle, len(nodes),
+                         current_cycle - 1)
+            parent = None
+            popped = 0
+            # (node path, child name) where errors were found this cycle - name is None for the node itself
+            failed = []
+            counters['item_count'].reset()
+            counters['error_count'].reset()
+            counters['repair_count'].reset()
+
+            while nodes:
+                if prefetch_window and popped % prefetch_window == 0:
+                    # Nodes evicted from the cache since they were checked are reloaded together
+                    try:
+                        upcoming, resolved = [], None
+                        for queued in nodes.peek(prefetch_window):
+                            child, resolved = _resolve(topnode, queued, resolved)
+                            upcoming.append(child)
+                        _prefetch(connection, upcoming)
+                    except Exception as e:
+                        log.debug("Unable to prefetch queued nodes: %s: %s", type(e).__name__, e)
+                popped += 1
+                names = nodes.popleft()
                 try:
-                    if (counters['item_count'].value() % PROGRESS_INTERVAL) == 0:
-                        if not use_unlimited_memory:
-                            transaction.abort()
-                        progress_bar(counters['item_count'].value(), counters['error_count'].value(),
-                                     counters['repair_count'].value(), attempt_fix, current_cycle)
-                    counters['item_count'].increment()
-
-                    rel = node._getOb(name)
-                    rel()
-                    # ToManyContRelationship objects should have all referenced objects traversed
-                    if isinstance(rel, ToManyContRelationship):
-                        nodes.append(rel)
-                except SystemError as e:
-                    # to troubleshoot traceback in:
-                    #   https://dev.zenoss.com/tracint/pastebin/4769
-                    # ./findposkeyerror --fixrels /zport/dmd/
-                    #   SystemError: new style getargs format but argument is not a tuple
-                    log.critical("%s: %s on %s '%s' of %s", type(e).__name__, e, "relationship", name, path_string)
-                    raise  # Not sure why we are raising this vs. logging and continuing
+                    node, parent = _resolve(topnode, names, parent)
                 except _RELEVANT_EXCEPTIONS as e:
-                    counters['error_count'].increment()
-                    log.critical("%s: %s on %s '%s' of %s", type(e).__name__, e, "relationship", name, path_string)
-                    if attempt_fix:
-                        if isinstance(e, POSKeyError):
-                            fixPOSKeyError(type(e).__name__, e, "attribute", name, path, dmd, log, counters)
-                except Exception as e:
-                    log.critical("%s: %s on %s '%s' of %s", type(e).__name__, e, "relationship", name, path_string)
+                    # Checked when queued, so the object changed since (e.g. removed by a repair)
+                    log.warning("%s: %s while resolving %s", type(e).__name__, e, '/'.join(names))
+                    dirty.add(names[0])
+                    continue
+                counters['item_count'].increment()
+                path = node.getPhysicalPath()
+                path_string = "/".join(path)
+
+                if (counters['item_count'].value() % PROGRESS_INTERVAL) == 0:
+                    free_memory()
+                    progress_bar(counters['item_count'].value(), counters['error_count'].value(),
+                                 counters['repair_count'].value(), attempt_fix, current_cycle)
+
+                if isinstance(node, Device):
+                    devices.append((names, path_string, node))
+                    if len(devices) >= DEVICE_BATCH_SIZE:
+                        check_devices()
 
-            for name in attributes:
                 try:
-                    if (counters['item_count'].value() % PROGRESS_INTERVAL) == 0:
-                        if not use_unlimited_memory:
-                            transaction.abort()
-                        progress_bar(counters['item_count'].value(), counters['error_count'].value(),
-                                     counters['repair_count'].value(), attempt_fix, current_cycle)
-                    counters['item_count'].increment()
-                    if name == "temp_folder" and path_string == "": # skip session db
-                        continue
-                    childnode = node._getOb(name)
-                    childnode.getId()
+                    attributes, relationships = _getEdges(node, path_string, attempt_fix, counters, log, repairs, found,
+                                                          check_uptime=False)
                 except _RELEVANT_EXCEPTIONS as e:
+                    log.critical("%s: %s %s '%s'", type(e).__name__, e, "while retreiving children of", path_string)
                     counters['error_count'].increment()
-                    log.critical("%s: %s on %s '%s' of %s", type(e).__name__, e, "attribute", name, path_string)
+                    failed.append((names, None))
+                    fix_status = None
                     if attempt_fix:
+                        fix_status = "unfixable"
                         if isinstance(e, POSKeyError):
-                            fixPOSKeyError(type(e).__name__, e, "attribute", name, path, dmd, log, counters)
+                            fix_status = fixPOSKeyError(type(e).__name__, e, "node", name, path, dmd, log, counters,
+                                                        repairs)
+                    found(e, "children", None, path_string, fix_status)
+                    continue
                 except Exception as e:
-                    log.critical("%s: %s on %s '%s' of %s", type(e).__name__, e, "relationship", name, path_string)
-                else:
-                    # No exception, so it should be safe to add this child node as a traversable object.
-                    nodes.append(childnode)
-
-        if not use_unlimited_memory:
+                    log.exception(e)
+                    # Not counted as an error, but the subtree wasn't fully checked - so not fingerprinted either
+                    if names:
+                        dirty.add(names[0])
+
+                # Every container counts, empty ones too - a child added to one only changes its own serial
+                if fingerprints and current_cycle == 1 and names and hasattr(node.aq_base, "objectIds"):
+                    zoids, digest = containers.setdefault(names[0], (array('L'), hashlib.md5()))
+                    zoids.append(u64(node._p_oid))
+                    digest.update(node._p_oid + node._p_serial)
+
+                if prefetch_window:
+                    children = []
+                    for name in relationships | attributes:
+                        try:
+                            if name != "temp_folder":
+                                children.append(node._getOb(name))
+                        except Exception:
+                            pass  # Reported when the child is checked below
+                    try:
+                        _prefetch(connection, children)
+                    except Exception as e:
+                        log.debug("Unable to prefetch children of %s: %s: %s", path_string, type(e).__name__, e)
+
+                for name in relationships:
+                    try:
+                        if (counters['item_count'].value() % PROGRESS_INTERVAL) == 0:
+                            free_memory()
+                            progress_bar(counters['item_count'].value(), counters['error_count'].value(),
+                                         counters['repair_count'].value(), attempt_fix, current_cycle)
+                        counters['item_count'].increment()
+
+                        rel = node._getOb(name)
+                        rel()
+                        # ToManyContRelationship objects should have all referenced objects traversed
+                        if isinstance(rel, ToManyContRelationship) and descend(names, name):
+                            nodes.append(names + (name,))
+                    except SystemError as e:
+                        # to troubleshoot traceback in:
+                        #   https://dev.zenoss.com/tracint/pastebin/4769
+                        # ./findposkeyerror --fixrels /zport/dmd/
+                        #   SystemError: new style getargs format but argument is not a tuple
+                        log.critical("%s: %s on %s '%s' of %s", type(e).__name__, e, "relationship", name, path_string)
+                        found(e, "relationship", name, path_string)
+                        raise  # Not sure why we are raising this vs. logging and continuing
+                    except _RELEVANT_EXCEPTIONS as e:
+                        counters['error_count'].increment()
+                        failed.append((names, name))
+                        log.critical("%s: %s on %s '%s' of %s", type(e).__name__, e, "relationship", name, path_string)
+                        fix_status = None
+                        if attempt_fix:
+                            fix_status = "unfixable"
+                            if isinstance(e, POSKeyError):
+                                fix_status = fixPOSKeyError(type(e).__name__, e, "attribute", name, path, dmd, log,
+                                                            counters, repairs)
+                        found(e, "relationship", name, path_string, fix_status)
+                    except Exception as e:
+                        log.critical("%s: %s on %s '%s' of %s", type(e).__name__, e, "relationship", name, path_string)
+                        found(e, "relationship", name, path_string)
+                        dirty.add(names[0] if names else name)
+
+                for name in attributes:
+                    try:
+                        if (counters['item_count'].value() % PROGRESS_INTERVAL) == 0:
+                            free_memory()
+                            progress_bar(counters['item_count'].value(), counters['error_count'].value(),
+                                         counters['repair_count'].value(), attempt_fix, current_cycle)
+                        counters['item_count'].increment()
+                        if name == "temp_folder" and path_string == "": # skip session db
+                            continue
+                        childnode = node._getOb(name)
+                        childnode.getId()
+                    except _RELEVANT_EXCEPTIONS as e:
+                        counters['error_count'].increment()
+                        failed.append((names, name))
+                        log.critical("%s: %s on %s '%s' of %s", type(e).__name__, e, "attribute", name, path_string)
+                        fix_status = None
+                        if attempt_fix:
+                            fix_status = "unfixable"
+                            if isinstance(e, POSKeyError):
+                                fix_status = fixPOSKeyError(type(e).__name__, e, "attribute", name, path, dmd, log,
+                                                            counters, repairs)
+                        found(e, "attribute", name, path_string, fix_status)
+                    except Exception as e:
+                        log.critical("%s: %s on %s '%s' of %s", type(e).__name__, e, "relationship", name, path_string)
+                        found(e, "attribute", name, path_string)
+                        dirty.add(names[0] if names else name)
+                    else:
+                        # No exception, so it should be safe to add this child node as a traversable object.
+                        if descend(names, name):
+                            nodes.append(names + (name,))
+
+            check_devices()
+            if repairs:
+                repairs.flush()
+            if not use_unlimited_memory:
+                transaction.abort()
+
+            progress_bar(counters['item_count'].value(), counters['error_count'].value(),
+                         counters['repair_count'].value(), attempt_fix, current_cycle)
+            number_of_issues = counters['error_count'].value()
+            number_of_repairs = counters['repair_count'].value()
+            log.info("findposkeyerror cycle %s: examined %d objects, encountered %d errors, and committed %d repairs",
+                     current_cycle, counters['item_count'].value(), counters['error_count'].value(),
+                     counters['repair_count'].value())
+            if governor:
+                log.info("findposkeyerror cycle %s: connection cache collected %d and minimized %d times so far",
+                         current_cycle, governor.collections, governor.minimizations)
+
+            targets = {}
+            for names, name in failed:
+                if name is None:
+                    targets[names] = None
+                elif targets.get(names, ()) is not None:
+                    targets.setdefault(names, set()).add(name)
+                dirty.add(names[0] if names else name)
+    finally:
+        # Also when a cycle is cut short, so no finding still queued is lost
+        if findings:
+            findings.close()
+
+    if fingerprints:
+        # Fingerprint the subtrees walked in the first cycle; those with errors are scanned fully next time
+        for name, (zoids, digest) in containers.iteritems():
+            if name not in dirty:
+                fingerprints.update(name, zoids, digest.digest())
+        for name in dirty:
+            fingerprints.discard(name)
+        fingerprints.close()
+        log.info("%d subtrees skipped as unchanged, %d fingerprinted, %d with errors", len(unchanged),
+                 len(set(containers) - dirty), len(dirty))
+
+
+_worker_dmd = None
+_worker_options = None
+_worker_log = None
+_worker_totals = None
+
+
+def _init_worker(options, log, totals, commit_lock):
+    """ Pool initializer - every worker process gets its own dmd connection; progress is shown by the parent """
+    global _worker_dmd, _worker_options, _worker_log, _worker_totals, _commit_lock
+    sys.stdout = open(os.devnull, 'w')
+    _worker_options, _worker_log, _worker_totals, _commit_lock = options, log, totals, commit_lock
+    _worker_dmd = ZenScriptBase(noopts=True, connect=True).dmd
+
+
+def _scan_subtree(task):
+    """ Scans the subtree at path (except the children in skip), returning the counters of its last cycle and
+        whether the scan failed before completing """
+    path, skip = task
+    failed = False
+    counters = dict((name, ZenToolboxUtils.Counter(0, total)) for name, total in _worker_totals.iteritems())
+    try:
+        folder = _worker_dmd.getObjByPath(path)
+    except Exception as e:
+        # The subtree root itself is checked (and reported) by the scan of its parent
+        _worker_log.warning("Unable to load %s: %s: %s", path, type(e).__name__, e)
+        transaction.abort()
+    else:
+        _worker_log.info("Worker %s examining items under %s", os.getpid(), path)
+        try:
+            findPOSKeyErrors(folder, _worker_options['fix'], _worker_options['unlimitedram'], _worker_dmd,
+                             _worker_log, counters, _worker_options['cycles'], skip,
+                             _worker_options['memory_budget'], _worker_options['prefetch'],
+                             _worker_options['incremental'], _worker_options['commit_batch'],
+                             _worker_options['findings_out'])
+        except Exception as e:
+            _worker_log.error("Unable to scan %s: %s: %s\n%s", path, type(e).__name__, e, traceback.format_exc())
             transaction.abort()
-
-        progress_bar(counters['item_count'].value(), counters['error_count'].value(),
-                     counters['repair_count'].value(), attempt_fix, current_cycle)
-        number_of_issues = counters['error_count'].value()
-        number_of_repairs = counters['repair_count'].value()
-        log.info("findposkeyerror cycle %s: examined %d objects, encountered %d errors, and attempted %d repairs",
-                  current_cycle, counters['item_count'].value(), counters['error_count'].value(), counters['repair_count'].value())
+            failed = True
+    return path, dict((name, counter.value()) for name, counter in counters.iteritems()), failed
+
+
+def findPOSKeyErrorsParallel(topnode, path, workers, cli_options, log, counters):
+    """ Scans each child of topnode in its own worker process (and topnode itself, without descending into
+        those children), adding the counters of the last cycle of every subtree into counters. A subtree whose
+        scan failed counts as one more error. Returns the paths of those subtrees. """
+    relationships = set(topnode.getRelationshipNames() if hasattr(topnode.aq_base, "getRelationshipNames") else [])
+    children = sorted(set(topnode.objectIds() if hasattr(topnode.aq_base, "objectIds") else []) - relationships)
+    if path == "/":
+        children = [name for name in children if name != "temp_folder"]  # skip session db
+    base = path.rstrip('/')
+    tasks = [(path, tuple(children))] + [("%s/%s" % (base, name), ()) for name in children]
+    log.info("Scanning %d subtrees of %s with %d worker processes", len(tasks) - 1, path, workers)
+    transaction.abort()
+
+    # Live totals of every worker (all cycles) for the progress line
+    totals = dict((name, ZenToolboxUtils.Counter(0)) for name in counters)
+    pool = multiprocessing.Pool(workers, _init_worker, (cli_options, log, totals, multiprocessing.Lock()))
+    try:
+        results = pool.imap_unordered(_scan_subtree, tasks)
+        failures = []
+        done = 0
+        while done < len(tasks):
+            try:
+                subtree, values, failed = results.next(timeout=1)
+            except multiprocessing.TimeoutError:
+                pass
+            else:
+                done += 1
+                log.info("Finished %s (%d of %d subtrees): %d items, %d errors, %d repairs", subtree, done,
+                         len(tasks), values['item_count'], values['error_count'], values['repair_count'])
+                for name, value in values.iteritems():
+                    counters[name].increment(value)
+                if failed:
+                    failures.append(subtree)
+                    counters['error_count'].increment()
+                    totals['error_count'].increment()
+            inline_print("[%s]  Workers %d  | Items Scanned: %12d | Errors:  %6d | Repairs: %6d | Subtrees: %d/%d  " %
+                         (time.strftime("%Y-%m-%d %H:%M:%S"), workers, totals['item_count'].value(),
+                          totals['error_count'].value(), totals['repair_count'].value(), done, len(tasks)))
+    finally:
+        pool.close()
+        pool.join()
+    print
+    log.info("findposkeyerror: examined %d objects, encountered %d errors, and committed %d repairs (last cycle "
+             "of each subtree)", counters['item_count'].value(), counters['error_count'].value(),
+             counters['repair_count'].value())
+    if failures:
+        print("[%s] Unable to scan %d subtree(s) - consult the log file:" %
+              (time.strftime("%Y-%m-%d %H:%M:%S"), len(failures)))
+        for subtree in sorted(failures):
+            print("    %s" % (subtree))
+        log.error("Unable to scan %d subtree(s): %s", len(failures), ", ".join(sorted(failures)))
+    return failures
 
 
 def main():
@@ -448,6 +1116,21 @@ def main():
                         help="base path to scan from (Devices.Server)?")
     parser.add_argument("-u", "--unlimitedram", action="store_true", default=False,
                         help="skip transaction.abort() - unbounded RAM, ~40%% faster")
+    parser.add_argument("-w", "--workers", action="store", default=1, type=int,
+                        help="scan each child of the base path in one of N worker processes")
+    parser.add_argument("-m", "--memory-budget", action="store", default=0, type=int,
+                        help="free the ZODB cache only when a process exceeds N MB of RSS - near --unlimitedram "
+                             "speed with bounded RAM (default 0: transaction.abort() every 829 items)")
+    parser.add_argument("--prefetch", action="store", default=100, type=int,
+                        help="load the children of each node and the next N queued nodes in one batch where "
+                             "ZODB supports prefetching (default 100, 0 to disable)")
+    parser.add_argument("-i", "--incremental", action="store_true", default=False,
+                        help="skip subtrees of the base path that were clean in the last run and whose "
+                             "containers have not been modified since")
+    parser.add_argument("--commit-batch", action="store", default=100, type=int,
+                        help="with --fix, commit repairs N at a time (default 100)")
+    parser.add_argument("--findings-out", action="store", default="",
+                        help="also write each error found to FILE as one JSON line")
     cli_options = vars(parser.parse_args())
     log, logFileName = ZenToolboxUtils.configure_logging(scriptName, scriptVersion, cli_options['tmpdir'])
     log.info("Command line options: %s" % (cli_options))
@@ -461,6 +1144,11 @@ def main():
     if not ZenToolboxUtils.get_lock("zenoss.toolbox", log):
         sys.exit(1)
 
+    if cli_options['fix']:
+        register_fixers(log)
+    if cli_options['findings_out']:
+        open(cli_options['findings_out'], 'w').close()
+
     # Obtain dmd ZenScriptBase connection
     dmd = ZenScriptBase(noopts=True, connect=True).dmd
     log.debug("ZenScriptBase connection obtained")
@@ -484,7 +1172,13 @@ def main():
         print("[%s] Examining items under the '%s' path (%s):" %
               (strftime("%Y-%m-%d %H:%M:%S", localtime()), cli_options['path'], folder))
         log.info("Examining items under the '%s' path (%s)", cli_options['path'], folder)
-        findPOSKeyErrors(folder, cli_options['fix'], cli_options['unlimitedram'], dmd, log, counters, cli_options['cycles'])
+        if cli_options['workers'] > 1:
+            findPOSKeyErrorsParallel(folder, processed_path, cli_options['workers'], cli_options, log, counters)
+        else:
+            findPOSKeyErrors(folder, cli_options['fix'], cli_options['unlimitedram'], dmd, log, counters,
+                             cli_options['cycles'], memory_budget=cli_options['memory_budget'],
+                             prefetch_window=cli_options['prefetch'], incremental=cli_options['incremental'],
+                             commit_batch=cli_options['commit_batch'], findings_out=cli_options['findings_out'])
         print
 
     print("\n[%s] Execution finished in %s\n" %
@@ -0,0 +1,120 @@
+##############################################################################
+#
+# Copyright (C) Zenoss, Inc. 2020, all rights reserved.
+#
+# This content is made available according to terms specified in
+# License.zenoss under the directory where your Zenoss product is installed.
+#
+##############################################################################
+
+import cPickle
+import re
+import unittest
+
+from contextlib import contextmanager
+from zenoss.toolbox import zodbscan
+from zenoss.toolbox.ZenToolboxUtils import Counter
+from ZODB.utils import p64
+
+
+def pickled(zoid):
+    return cPickle.dumps((dict, None), 1) + cPickle.dumps({'zoid': zoid}, 1)
+
+
+class FakeCursor(object):
+    """ Answers ObjectStateLoader's object_state queries from a dict of zoid -> (tid, state) """
+    def __init__(self, rows):
+        self._rows = rows
+        self._result = []
+        self.queries = []
+
+    def execute(self, query):
+        self.queries.append(query)
+        match = re.search(r"WHERE zoid IN \((.*)\)", query)
+        if match:
+            zoids = [int(zoid) for zoid in match.group(1).split(',')]
+            self._result = [(zoid, self._rows[zoid][1]) for zoid in zoids if zoid in self._rows]
+            return
+        match = re.search(r"WHERE tid > (\d+)", query)
+        since = int(match.group(1)) if match else -1
+        rows = [(zoid, tid, state) for zoid, (tid, state) in sorted(self._rows.items()) if tid > since]
+        if query.startswith("SELECT zoid FROM"):
+            rows = [(zoid,) for zoid, tid, state in rows]
+        self._result = rows
+
+    def fetchall(self):
+        result, self._result = self._result, []
+        return result
+
+    def fetchmany(self, size):
+        result, self._result = self._result[:size], self._result[size:]
+        return result
+
+
+class FakeCursors(object):
+    """ Stands in for RelStorageCursors, keeping every cursor it hands out """
+    def __init__(self, rows):
+        self._rows = rows
+        self.opened = []
+
+    @contextmanager
+    def cursor(self, server_side=False):
+        cursor = FakeCursor(self._rows)
+        cursor.server_side = server_side
+        self.opened.append(cursor)
+        yield cursor
+
+
+class ObjectStateLoaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rows = dict((zoid, (100 + zoid, pickled(zoid))) for zoid in xrange(1, 11))
+        self.rows[4] = (104, '')  # a row without a state, as left behind by a history-free pack
+        self.cursors = FakeCursors(self.rows)
+        self.loader = zodbscan.ObjectStateLoader(None, chunk_size=3, cursors=self.cursors)
+
+    def queried_zoids(self):
+        queries = self.cursors.opened[-1].queries
+        return [[int(z) for z in re.search(r"IN \((.*)\)", q).group(1).split(',')] for q in queries]
+
+    def test_load_states_chunks(self):
+        oids = [p64(zoid) for zoid in xrange(1, 8)]
+        states = self.loader.load_states(oids)
+        self.assertEqual(self.queried_zoids(), [[1, 2, 3], [4, 5, 6], [7]])
+        self.assertEqual(sorted(states), [p64(zoid) for zoid in (1, 2, 3, 5, 6, 7)])
+        self.assertEqual(states[p64(7)], pickled(7))
+        self.assertFalse(self.cursors.opened[-1].server_side)
+
+    def test_load_states_exact_multiple_of_chunk(self):
+        self.loader.load_states([p64(zoid) for zoid in xrange(1, 7)])
+        self.assertEqual(self.queried_zoids(), [[1, 2, 3], [4, 5, 6]])
+
+    def test_load_states_no_oids(self):
+        self.assertEqual(self.loader.load_states([]), {})
+        self.assertEqual(self.cursors.opened[-1].queries, [])
+
+    def test_missing_rows_are_poskeyerrors(self):
+        oids = [p64(zoid) for zoid in (3, 4, 42, 5)]
+        results, stats = zodbscan.load_refs(self.loader, oids, Counter(0))
+        missing = [oid for oid, refs in results if refs is None]
+        self.assertEqual(missing, [p64(4), p64(42)])
+        self.assertEqual([oid for oid, refs in results], oids)
+        self.assertEqual(stats['objects'], 2)
+
+    def test_iter_states_streams(self):
+        states = list(self.loader.iter_states())
+        self.assertTrue(self.cursors.opened[-1].server_side)
+        self.assertEqual([oid for oid, tid, state in states], [p64(z) for z in xrange(1, 11) if z != 4])
+        self.assertEqual(states[0], (p64(1), p64(101), pickled(1)))
+
+    def test_iter_states_since_tid(self):
+        states = list(self.loader.iter_states(since_tid=107))
+        self.assertEqual([oid for oid, tid, state in states], [p64(8), p64(9), p64(10)])
+
+    def test_iter_zoids(self):
+        self.assertEqual(list(self.loader.iter_zoids()), range(1, 11))
+        self.assertTrue(self.cursors.opened[-1].server_side)
+
+
+if __name__ == '__main__':
+    unittest.main()
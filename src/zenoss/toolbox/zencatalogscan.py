@@ -20,6 +20,7 @@ import argparse
 import datetime
 import Globals
 import logging
+import multiprocessing
 import os
 import sys
 import time
@@ -27,6 +28,7 @@ import traceback
 import transaction
 import ZenToolboxUtils
 
+from BTrees.IIBTree import difference, IISet
 from Products.ZenUtils.ZenScriptBase import ZenScriptBase
 from ZenToolboxUtils import inline_print
 from ZODB.transact import transact
@@ -50,6 +52,17 @@ class CatalogScanInfo(object):
         self.dmdPath = actualPath
         self.initialSize = 0
         self.runResults = {}  # Dict to hold int(cycle): { ZenToolboxUtils.Counters }
+        self.progress = None  # Shared counters of the current cycle, when scanned in a worker process
+
+    def start_cycle(self, cycle):
+        """Sets up the counters of cycle, adding them into the shared progress counters (if any)"""
+        progress = self.progress or {}
+        for counter in progress.itervalues():
+            counter.reset()
+        if progress:
+            progress['cycle'].increment(cycle)
+        self.runResults[cycle] = dict((name, ZenToolboxUtils.Counter(0, progress.get(name)))
+                                      for name in ('itemCount', 'errorCount', 'repairCount'))
 
     def size(self):
         raise NotImplementedError
@@ -169,11 +182,6 @@ def global_catalog_paths_to_uids(catalogObject, fix, dmd, log, createEvents):
     catalogReference = eval(catalogObject.dmdPath)._catalog
     catalogObject.initialSize = len(catalogReference.paths)
 
-    if (catalogObject.initialSize > 50):
-        progressBarChunkSize = (catalogObject.initialSize // 50) + 1
-    else:
-        progressBarChunkSize = 1
-
     log.info("Examining global_catalog._catalog.paths for consistency against ._catalog.uids")
     print("[%s] Examining %-35s (%d Objects)" %
           (time.strftime("%Y-%m-%d %H:%M:%S"), "global_catalog 'paths to uids'", catalogObject.initialSize))
@@ -191,26 +199,32 @@ def global_catalog_paths_to_uids(catalogObject, fix, dmd, log, createEvents):
 
         try:
             broken_rids = []
-            for rid, path in catalogReference.paths.iteritems():
-                catalogObject.runResults[currentCycle]['itemCount'].increment()
-                if (catalogObject.runResults[currentCycle]['itemCount'].value() % progressBarChunkSize) == 0:
-                    chunkNumber = catalogObject.runResults[currentCycle]['itemCount'].value() // progressBarChunkSize
-                    scan_progress_message(False, fix, currentCycle, "global_catalog 'paths to uids'",
-                                          catalogObject.runResults[currentCycle]['errorCount'].value(), chunkNumber,
-                                          log)
-                if path not in catalogReference.uids:
-                    catalogObject.runResults[currentCycle]['errorCount'].increment()
-                    broken_rids.append(rid)
+            broken_uids = []
+            # Compare the rids held by paths with the rids uids refers to as whole sets, not path by path
+            pathRids = IISet(catalogReference.paths.keys())
+            uidRids = IISet(catalogReference.uids.values())
+            catalogObject.runResults[currentCycle]['itemCount'].increment(len(pathRids))
+            # Only a rid that uids doesn't refer to can have a path missing from uids (rids may share a path)
+            broken_rids = [rid for rid in difference(pathRids, uidRids)
+                           if catalogReference.paths[rid] not in catalogReference.uids]
+            missingRids = difference(uidRids, pathRids)
+            if len(missingRids):
+                broken_uids = [uid for uid, rid in catalogReference.uids.iteritems() if rid in missingRids]
+            for uid in broken_uids:
+                log.error("global_catalog._catalog.uids contains %s without a path" % (uid))
+            log.info("global_catalog: %d paths without uids, %d uids without paths" %
+                     (len(broken_rids), len(broken_uids)))
+            catalogObject.runResults[currentCycle]['errorCount'].increment(len(broken_rids) + len(broken_uids))
 
         except Exception, e:
             log.exception(e)
 
         scan_progress_message(True, fix, currentCycle, "global_catalog 'paths to uids' consistency",
-                              catalogObject.runResults[currentCycle]['errorCount'].value(), chunkNumber, log)
+                              catalogObject.runResults[currentCycle]['errorCount'].value(), 50, log)
 
         if fix:
             if catalogObject.runResults[currentCycle]['errorCount'].value() > 0:
-                log.info("Attempting to repair %d detected issues", len(broken_rids))
+                log.info("Attempting to repair %d detected issues", len(broken_rids) + len(broken_uids))
                 for item in broken_rids:
                     try:
                         catalogObject.runResults[currentCycle]['repairCount'].increment()
@@ -220,6 +234,14 @@ def global_catalog_paths_to_uids(catalogObject, fix, dmd, log, createEvents):
                         transaction.commit()
                     except:
                         pass
+                for item in broken_uids:
+                    try:
+                        catalogObject.runResults[currentCycle]['repairCount'].increment()
+                        catalogReference.uids.pop(item)
+                        catalogReference._p_changed = True
+                        transaction.commit()
+                    except:
+                        pass
             else:
                 break
             if currentCycle > 1:
@@ -267,8 +289,114 @@ def global_catalog_paths_to_uids(catalogObject, fix, dmd, log, createEvents):
     return (catalogObject.runResults[currentCycle]['errorCount'].value() != 0)
 
 
-def scan_catalog(catalogObject, fix, dmd, log, createEvents):
-    """Scan through a catalog looking for broken references"""
+class ObjectVerifier(object):
+    """Checks that catalogued paths resolve to objects that can be loaded.  With fast, the container of each
+    path is looked up once (kept in an LRU cache by path, its own container found the same way) and the entry
+    is checked by loading its record from the storage, without activating it.  Paths where that can't be
+    done (not reachable with _getOb, not persistent) fall back to a full traversal."""
+    CONTAINER_CACHE_SIZE = 10000
+
+    def __init__(self, app, fast=False):
+        self.app = app
+        self.fast = fast
+        self.containers = ZenToolboxUtils.LRUCache(self.CONTAINER_CACHE_SIZE)
+
+    def get_container(self, path):
+        if not path:
+            return self.app
+        container = self.containers.get(path)
+        if container is None:
+            parentPath, _, name = path.rpartition('/')
+            container = self.get_container(parentPath)._getOb(name)
+            self.containers[path] = container
+        return container
+
+    def verify(self, path):
+        """Raises an exception if path doesn't resolve to an object that can be loaded"""
+        if self.fast:
+            try:
+                parentPath, _, name = path.rstrip('/').rpartition('/')
+                testReference = self.get_container(parentPath)._getOb(name)
+                oid, jar = testReference._p_oid, testReference._p_jar
+            except Exception:
+                oid = jar = None
+            if oid is not None and jar is not None:
+                jar._storage.load(oid, '')
+                return
+        testReference = self.app.unrestrictedTraverse(path)
+        testReference._p_deactivate()
+
+
+_worker_verifier = None
+_worker_log = None
+
+
+def _init_worker(log, fast):
+    """Pool initializer - every worker process gets its own dmd connection; progress is shown by the parent"""
+    global _worker_verifier, _worker_log
+    sys.stdout = open(os.devnull, 'w')
+    _worker_log = log
+    _worker_verifier = ObjectVerifier(ZenScriptBase(noopts=True, connect=True).dmd.getPhysicalRoot(), fast)
+
+
+def _verify_paths(paths):
+    """Loads the object at each of paths (as brain.getObject() would), returning the paths that can't be loaded"""
+    broken = []
+    for path in paths:
+        try:
+            _worker_verifier.verify(path)
+        except Exception:
+            broken.append(path)
+    # Pick up changes committed by the coordinator and free the objects loaded for this chunk
+    transaction.abort()
+    return paths, broken
+
+
+def report_broken_object(catalogObject, currentCycle, objectPathString, fix, log):
+    """Count (and with fix, uncatalog) an entry of catalogObject that doesn't resolve to an object"""
+    catalogObject.runResults[currentCycle]['errorCount'].increment()
+    log.error("Catalog %s contains broken object %s" % (catalogObject.prettyName, objectPathString))
+    if fix:
+        log.info("Attempting to uncatalog %s" % (objectPathString))
+        try:
+            catalogObject.runResults[currentCycle]['repairCount'].increment()
+            transact(catalogObject.uncatalog_object)(objectPathString)
+        except Exception as e:
+            log.exception(e)
+
+
+def verify_brains_parallel(catalogObject, brains, pool, fix, currentCycle, progressBarChunkSize, log,
+                           chunkSize=1000):
+    """Resolves the paths of brains in chunks across the worker pool; broken entries are handled here.
+    Returns the last progress bar chunk shown."""
+    paths = [brain.getPath() for brain in brains]
+    chunks = [paths[i:i + chunkSize] for i in xrange(0, len(paths), chunkSize)]
+    results = pool.imap_unordered(_verify_paths, chunks)
+    itemCount = catalogObject.runResults[currentCycle]['itemCount']
+    errorCount = catalogObject.runResults[currentCycle]['errorCount']
+    chunkNumber = 0
+    done = 0
+    while done < len(chunks):
+        try:
+            chunk, broken = results.next(timeout=1)
+        except multiprocessing.TimeoutError:
+            pass
+        else:
+            done += 1
+            itemCount.increment(len(chunk))
+            for objectPathString in broken:
+                report_broken_object(catalogObject, currentCycle, objectPathString, fix, log)
+        if itemCount.value() // progressBarChunkSize > chunkNumber:
+            chunkNumber = itemCount.value() // progressBarChunkSize
+            scan_progress_message(False, fix, currentCycle, catalogObject.prettyName, errorCount.value(),
+                                  chunkNumber, log)
+    return chunkNumber
+
+
+def scan_catalog(catalogObject, fix, dmd, log, createEvents, pool=None, fast=False):
+    """Scan through a catalog looking for broken references (resolving them across pool's workers, if given)"""
+
+    verifier = ObjectVerifier(dmd.getPhysicalRoot(), fast) if fast else None
 
     # Fix for ZEN-14717 (only for global_catalog)
     if (catalogObject.prettyName == 'global_catalog'):
@@ -284,10 +412,7 @@ def scan_catalog(catalogObject, fix, dmd, log, createEvents):
 
     while (currentCycle < maxCycles):
         currentCycle += 1
-        catalogObject.runResults[currentCycle] = {'itemCount': ZenToolboxUtils.Counter(0),
-                                                  'errorCount': ZenToolboxUtils.Counter(0),
-                                                  'repairCount': ZenToolboxUtils.Counter(0)
-                                                  }
+        catalogObject.start_cycle(currentCycle)
         log.info("Beginning cycle %d for catalog %s" % (currentCycle, catalogObject.prettyName))
         scan_progress_message(False, fix, currentCycle, catalogObject.prettyName, 0, 0, log)
 
@@ -302,6 +427,11 @@ def scan_catalog(catalogObject, fix, dmd, log, createEvents):
         else:
             progressBarChunkSize = 1
 
+        if pool is not None:
+            chunkNumber = verify_brains_parallel(catalogObject, brains, pool, fix, currentCycle,
+                                                 progressBarChunkSize, log)
+            brains = []
+
         for brain in brains:
             catalogObject.runResults[currentCycle]['itemCount'].increment()
             if (catalogObject.runResults[currentCycle]['itemCount'].value() % progressBarChunkSize) == 0:
@@ -309,19 +439,13 @@ def scan_catalog(catalogObject, fix, dmd, log, createEvents):
                 scan_progress_message(False, fix, currentCycle, catalogObject.prettyName,
                                       catalogObject.runResults[currentCycle]['errorCount'].value(), chunkNumber, log)
             try:
-                testReference = brain.getObject()
-                testReference._p_deactivate()
+                if verifier is not None:
+                    verifier.verify(brain.getPath())
+                else:
+                    testReference = brain.getObject()
+                    testReference._p_deactivate()
             except Exception:
-                catalogObject.runResults[currentCycle]['errorCount'].increment()
-                objectPathString = brain.getPath()
-                log.error("Catalog %s contains broken object %s" % (catalogObject.prettyName, objectPathString))
-                if fix:
-                    log.info("Attempting to uncatalog %s" % (objectPathString))
-                    try:
-                        catalogObject.runResults[currentCycle]['repairCount'].increment()
-                        transact(catalogObject.uncatalog_object)(objectPathString)
-                    except Exception as e:
-                        log.exception(e)
+                report_broken_object(catalogObject, currentCycle, brain.getPath(), fix, log)
 
         # Final transaction.abort() to try and free up used memory
         log.debug("Calling transaction.abort() to minimize memory footprint")
@@ -378,6 +502,105 @@ def scan_catalog(catalogObject, fix, dmd, log, createEvents):
     return (catalogObject.runResults[currentCycle]['errorCount'].value() != 0)
 
 
+class ProgressDashboard(object):
+    """Multi-line progress display - finished lines scroll up above a block of lines redrawn in place"""
+    def __init__(self, stream=sys.stdout):
+        self.stream = stream
+        self.height = 0
+
+    def update(self, lines, finished=()):
+        output = []
+        if self.height:
+            output.append("\033[%dA" % (self.height))
+        output.append("\r\033[J")
+        for line in list(finished) + list(lines):
+            output.append("%s\n" % (line))
+        self.height = len(lines)
+        self.stream.write(''.join(output))
+        self.stream.flush()
+
+
+_catalog_worker_catalogs = None
+_catalog_worker_progress = None
+_catalog_worker_log = None
+
+
+def _init_catalog_worker(log, progress):
+    """Pool initializer - every worker process gets its own dmd connection and catalog list"""
+    global _catalog_worker_catalogs, _catalog_worker_progress, _catalog_worker_log
+    sys.stdout = open(os.devnull, 'w')
+    _catalog_worker_log, _catalog_worker_progress = log, progress
+    dmd = ZenScriptBase(noopts=True, connect=True).dmd
+    _catalog_worker_catalogs = dict((item.prettyName, item) for item in build_catalog_list(dmd, log))
+
+
+def _scan_catalog_task(task):
+    """Scans one catalog in a worker process, returning its name and whether issues remain"""
+    name, fix, createEvents, fast = task
+    catalogObject = _catalog_worker_catalogs.get(name)
+    if catalogObject is None:
+        _catalog_worker_log.error("Catalog %s not found by worker %s" % (name, os.getpid()))
+        return name, True
+    catalogObject.progress = _catalog_worker_progress[name]
+    try:
+        return name, scan_catalog(catalogObject, fix, catalogObject.dmd, _catalog_worker_log, createEvents,
+                                  fast=fast)
+    except Exception as e:
+        _catalog_worker_log.exception(e)
+        transaction.abort()
+        return name, True
+
+
+def scan_catalogs_concurrently(catalogList, processes, fix, log, createEvents, fast=False):
+    """Scans up to processes catalogs at once in worker processes, largest first.  Returns True if any issues
+    remain."""
+    sizes = dict((item.prettyName, item.size()) for item in catalogList)
+    names = sorted(sizes, key=lambda name: sizes[name], reverse=True)
+    progress = dict((name, dict((counter, ZenToolboxUtils.Counter(0))
+                                for counter in ('cycle', 'itemCount', 'errorCount', 'repairCount')))
+                    for name in names)
+    log.info("Scanning %d catalogs with %d worker processes" % (len(names), processes))
+    print("[%s] Scanning %d catalogs, %d at a time" % (time.strftime("%Y-%m-%d %H:%M:%S"), len(names), processes))
+    transaction.abort()
+
+    anyIssue = False
+    done = set()
+    dashboard = ProgressDashboard()
+    pool = multiprocessing.Pool(processes, _init_catalog_worker, (log, progress))
+    try:
+        results = pool.imap_unordered(_scan_catalog_task, [(name, fix, createEvents, fast) for name in names])
+        while len(done) < len(names):
+            finished = []
+            try:
+                name, issue = results.next(timeout=1)
+            except multiprocessing.TimeoutError:
+                pass
+            else:
+                done.add(name)
+                anyIssue = issue or anyIssue
+                errors = progress[name]['errorCount'].value()
+                finished.append("[%s]  %-8s  %-35s %10d Objects  [%d Issues Detected]" %
+                                (time.strftime("%Y-%m-%d %H:%M:%S"), "WARNING" if issue else "Verified", name,
+                                 sizes[name], errors))
+            lines = []
+            for name in names:
+                cycle = progress[name]['cycle'].value()
+                if name in done or not cycle:
+                    continue
+                items = progress[name]['itemCount'].value()
+                chunk = min(50, 50 * items // max(sizes[name], 1))
+                lines.append("[%s]  Cycle %2d  %-35s [%-50s] %3d%% [%d Issues Detected]" %
+                             (time.strftime("%Y-%m-%d %H:%M:%S"), cycle, name, '=' * chunk, 2 * chunk,
+                              progress[name]['errorCount'].value()))
+            lines.append("[%s]  Catalogs: %d/%d done, %d running" %
+                         (time.strftime("%Y-%m-%d %H:%M:%S"), len(done), len(names), len(lines)))
+            dashboard.update(lines, finished)
+    finally:
+        pool.close()
+        pool.join()
+    return anyIssue
+
+
 def build_catalog_list(dmd, log):
     """Builds a list of catalogs that are (present and not empty)"""
 
@@ -454,6 +677,14 @@ def main():
     parser.add_argument("--force-fix", action="store_true", default=False,
                         help="continue without prompting, relevant "
                              "to '-f' option, but it may damage your data")
+    parser.add_argument("-w", "--workers", action="store", default=1, type=int,
+                        help="resolve catalog entries in N worker processes")
+    parser.add_argument("--fast", action="store_true", default=False,
+                        help="check each entry by loading its record from its (cached) container "
+                             "instead of traversing its whole path")
+    parser.add_argument("-j", "--concurrent", action="store", default=1, type=int,
+                        help="scan up to N catalogs at once in worker processes, largest first "
+                             "(not together with --workers)")
     cliOptions = vars(parser.parse_args())
     log, logFileName = ZenToolboxUtils.configure_logging(scriptName, scriptVersion, cliOptions['tmpdir'])
     log.info("Command line options: %s" % (cliOptions))
@@ -463,6 +694,14 @@ def main():
     print "\n[%s] Initializing %s v%s (detailed log at %s)" % \
           (time.strftime("%Y-%m-%d %H:%M:%S"), scriptName, scriptVersion, logFileName)
 
+    # Concurrent catalog scans each resolve their entries in their own process - there is no pool to share
+    if cliOptions['workers'] > 1 and cliOptions['concurrent'] > 1 and not cliOptions['catalog'] and \
+            not cliOptions['list']:
+        print("Options --workers and --concurrent can't be combined without --catalog - pick one")
+        log.error("CLI options --workers %d and --concurrent %d can't be combined without --catalog" %
+                  (cliOptions['workers'], cliOptions['concurrent']))
+        exit(1)
+
     # Give user option to stop if he hadn't run findposkeyerror, zenrelationscan, zodbscan
     if cliOptions["fix"] and not cliOptions["force_fix"]:
         while True:
@@ -495,6 +734,11 @@ def main():
         maxCycles = 1
 
     validCatalogList = build_catalog_list(dmd, log)
+    pool = None
+    if cliOptions['workers'] > 1 and not cliOptions['list']:
+        log.info("Resolving catalog entries with %d worker processes" % (cliOptions['workers']))
+        transaction.abort()
+        pool = multiprocessing.Pool(cliOptions['workers'], _init_worker, (log, cliOptions['fast']))
     if cliOptions['list']:
         print "List of supported Zenoss catalogs to examine:\n"
         for item in validCatalogList:
@@ -507,15 +751,21 @@ def main():
                 if cliOptions['catalog'] == item.prettyName:
                     foundItem = True
                     anyIssue = scan_catalog(item, cliOptions['fix'],
-                                            dmd, log, not cliOptions['skipEvents'])
+                                            dmd, log, not cliOptions['skipEvents'], pool, cliOptions['fast'])
             if not foundItem:
                 print("Catalog '%s' unrecognized - unable to scan" % (cliOptions['catalog']))
                 log.error("CLI input '%s' doesn't match recognized catalogs" % (cliOptions['catalog']))
                 exit(1)
+        elif cliOptions['concurrent'] > 1:
+            anyIssue = scan_catalogs_concurrently(validCatalogList, cliOptions['concurrent'], cliOptions['fix'],
+                                                  log, not cliOptions['skipEvents'], cliOptions['fast'])
         else:
             for item in validCatalogList:
                 anyIssue = scan_catalog(item, cliOptions['fix'],
-                                        dmd, log, not cliOptions['skipEvents']) or anyIssue
+                                        dmd, log, not cliOptions['skipEvents'], pool, cliOptions['fast']) or anyIssue
+    if pool is not None:
+        pool.close()
+        pool.join()
 
     # Print final status summary, update log file with termination block
     print("\n[%s] Execution finished in %s\n" % (time.strftime("%Y-%m-%d %H:%M:%S"),
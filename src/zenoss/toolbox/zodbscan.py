@@ -14,38 +14,58 @@ documentationURL = "https://support.zenoss.com/hc/en-us/articles/203118175"
 
 
 import cStringIO
+import csv
 import datetime
+import functools
 import Globals
+import itertools
+import json
 import logging
+import multiprocessing
 import os
+import struct
 import sys
 import tempfile
 import time
 import ZConfig
 import ZenToolboxUtils
 
+from array import array
+from bisect import bisect_left
 from collections import deque
+from contextlib import contextmanager
+from MySQLdb.cursors import SSCursor
 from zodbpickle.pickle import Unpickler as UnpicklerBase
 from Products.ZenUtils.AutoGCObjectReader import gc_cache_every
 from Products.ZenUtils.GlobalConfig import getGlobalConfiguration
 from relstorage.zodbpack import schema_xml
 from time import localtime, strftime
-from ZenToolboxUtils import inline_print
+from ZenToolboxUtils import inline_print, LRUCache
 from ZODB.DB import DB
+from ZODB.FileStorage import FileStorage
 from ZODB.POSException import POSKeyError
-from ZODB.utils import u64
-from ZODB._compat import PersistentUnpickler
+from ZODB.serialize import referencesf
+from ZODB.utils import p64, u64
+try:
+    from zodbpickle import pickletools_2 as pickletools
+except ImportError:
+    import pickletools
 
 schema = ZConfig.loadSchemaFile(cStringIO.StringIO(schema_xml))
 
+BATCH_SIZE = 5000  # Number of oids handed to the loader (or to a worker process) at once
+
 
 class Analyzer(UnpicklerBase):
-    """ Able to analyze an object's pickle to try to figure out the name/class of the problem oid.  """
-    def __init__(self, pickle, problem_oid):
+    """ Able to analyze an object's pickle to try to figure out the name/class of the problem oid.
+        Without a problem oid every referenced oid gets its own marker, so one pass covers all children. """
+    def __init__(self, pickle, problem_oid=None):
         UnpicklerBase.__init__(self, cStringIO.StringIO(pickle))
         self.problem_oid = problem_oid
         self._marker = object()
         self.klass = None
+        self.markers = {}  # id(marker) -> (marker, oid), holding on to the marker so its id isn't reused
+        self.klasses = {}  # oid -> class
 
     def persistent_load(self, pickle_id):
         if isinstance(pickle_id, tuple):
@@ -53,24 +73,18 @@ class Analyzer(UnpicklerBase):
             if oid == self.problem_oid:
                 self.klass = klass
                 return self._marker
+            elif self.problem_oid is None:
+                marker = object()
+                self.markers[id(marker)] = (marker, oid)
+                self.klasses[oid] = klass
+                return marker
         else:
             pass
 
 
-def get_refs(p):
-    """ Generator-using version of ZODB.serialize.references """
-    refs = []
-    u = PersistentUnpickler(None, refs.append, cStringIO.StringIO(p))
-    u.noload()
-    u.noload()
-    for ref in refs:
-        if isinstance(ref, tuple):
-            yield ref[0]
-        elif isinstance(ref, str):
-            yield ref
-        else:
-            assert isinstance(ref, list)
-            yield ref[1][:2]
+def get_oids(p):
+    """ Returns the oids referenced by an object's pickle, less weak and cross-database references """
+    return referencesf(p)
 
 
 def get_config(database=None):
@@ -121,17 +135,747 @@ def get_config(database=None):
         return config
 
 
+def open_storage(database=None):
+    return get_config(database).storages[0].open()
+
+
+class StorageStateLoader(object):
+    """ Loads object states one at a time through storage.load() - works with any ZODB storage
+        (MappingStorage, FileStorage, ...) """
+    def __init__(self, storage):
+        self._storage = storage
+
+    def load_states(self, oids):
+        """ Returns a dict of oid -> state; oids that could not be loaded are absent """
+        states = {}
+        for oid in oids:
+            try:
+                states[oid] = self._storage.load(oid)[0]
+            except POSKeyError:
+                pass
+        return states
+
+    def iter_states(self, since_tid=None):
+        """ Yields (oid, tid, state) for every current object in oid order, only those changed after since_tid
+            (a u64) if given - needs record_iternext support """
+        next_oid = None
+        while True:
+            oid, tid, state, next_oid = self._storage.record_iternext(next_oid)
+            if since_tid is None or u64(tid) > since_tid:
+                yield oid, tid, state
+            if next_oid is None:
+                break
+
+    def iter_zoids(self):
+        """ Yields the u64 oid of every current object in oid order """
+        for oid, tid, state in self.iter_states():
+            yield u64(oid)
+
+
+class RelStorageCursors(object):
+    """ Opens cursors on the database behind a RelStorage - the only part of ObjectStateLoader that talks to
+        MySQL, so anything with the same cursor() can stand in for it """
+    def __init__(self, storage):
+        self._connmanager = storage._adapter.connmanager
+
+    @contextmanager
+    def cursor(self, server_side=False):
+        """ Yields a DB-API cursor, a server-side one that streams its rows if server_side """
+        conn, cursor = self._connmanager.open()
+        stream = conn.cursor(SSCursor) if server_side else None
+        try:
+            yield stream or cursor
+        finally:
+            if stream is not None:
+                stream.close()
+            self._connmanager.close(conn, cursor)
+
+
+class ObjectStateLoader(StorageStateLoader):
+    """ Loads object states in bulk straight from RelStorage's object_state table """
+    def __init__(self, storage, chunk_size=BATCH_SIZE, cursors=None):
+        super(ObjectStateLoader, self).__init__(storage)
+        self._chunk_size = chunk_size
+        self._cursors = cursors if cursors is not None else RelStorageCursors(storage)
+
+    def load_states(self, oids):
+        """ Returns a dict of oid -> state, chunk_size oids per query; oids without a row (or with an empty
+            state) are absent, which load_refs reports as POSKeyErrors """
+        states = {}
+        with self._cursors.cursor() as cursor:
+            for i in xrange(0, len(oids), self._chunk_size):
+                zoids = ','.join(str(u64(oid)) for oid in oids[i:i + self._chunk_size])
+                cursor.execute("SELECT zoid, state FROM object_state WHERE zoid IN (%s)" % zoids)
+                for zoid, state in cursor.fetchall():
+                    if state:
+                        states[p64(zoid)] = str(state)
+        return states
+
+    def _stream(self, query):
+        """ Yields the rows of query through a server-side cursor, chunk_size rows at a time """
+        with self._cursors.cursor(server_side=True) as stream:
+            stream.execute(query)
+            rows = stream.fetchmany(self._chunk_size)
+            while rows:
+                for row in rows:
+                    yield row
+                rows = stream.fetchmany(self._chunk_size)
+
+    def iter_states(self, since_tid=None):
+        """ Streams every row of object_state (only rows with tid > since_tid if given) in zoid order """
+        where = " WHERE tid > %d" % since_tid if since_tid is not None else ""
+        for zoid, tid, state in self._stream("SELECT zoid, tid, state FROM object_state%s ORDER BY zoid" % where):
+            if state:
+                yield p64(zoid), p64(tid), str(state)
+
+    def iter_zoids(self):
+        for zoid, in self._stream("SELECT zoid FROM object_state ORDER BY zoid"):
+            yield zoid
+
+
+def get_loader(storage):
+    """ Returns the fastest state loader supported by the storage """
+    if hasattr(storage, '_adapter'):
+        return ObjectStateLoader(storage)
+    return StorageStateLoader(storage)
+
+
+def get_class_name(p):
+    """ Returns the dotted class name of the object pickled in p, read from the GLOBAL opcode heading its class
+        metadata pickle without unpickling anything """
+    i = 2 if p[:1] == '\x80' else 0  # PROTO
+    if p[i:i + 1] == '(':  # MARK of a (class, args) tuple
+        i += 1
+    if p[i:i + 1] == 'c':
+        module_end = p.find('\n', i)
+        name_end = p.find('\n', module_end + 1)
+        if module_end > 0 and name_end > 0:
+            return "%s.%s" % (p[i + 1:module_end], p[module_end + 1:name_end])
+    # Any other layout - let pickletools find the first GLOBAL of the metadata pickle
+    try:
+        for opcode, arg, pos in pickletools.genops(cStringIO.StringIO(p)):
+            if opcode.name == 'GLOBAL':
+                return arg.replace(' ', '.')
+            if opcode.name == 'STOP':
+                break
+    except ValueError:
+        pass
+    return None
+
+
+def batch_stats(records, load_seconds, extract_seconds, census=False):
+    """ Summarizes a batch of (state, refs) records for ScanStats.add_batch - object count, pickle bytes,
+        pickle size histogram (bucket n counts sizes below 2**n bytes) and the time spent loading and
+        extracting references. With census, also per-class [objects, bytes, largest pickle, references,
+        most references, size histogram] """
+    sizes = [0] * 64
+    objects = total = 0
+    classes = {}
+    for state, refs in records:
+        bucket = len(state).bit_length()
+        objects += 1
+        total += len(state)
+        sizes[bucket] += 1
+        if census:
+            name = get_class_name(state)
+            tally = classes.get(name)
+            if tally is None:
+                tally = classes[name] = [0, 0, 0, 0, 0, [0] * 64]
+            tally[0] += 1
+            tally[1] += len(state)
+            tally[2] = max(tally[2], len(state))
+            tally[3] += len(refs)
+            tally[4] = max(tally[4], len(refs))
+            tally[5][bucket] += 1
+    return {'objects': objects, 'bytes': total, 'sizes': sizes, 'load': load_seconds, 'extract': extract_seconds,
+            'classes': classes}
+
+
+def load_refs(loader, oids, loaded, census=False):
+    """ Returns (oid, refs) for each oid, where refs is None if the object is missing (POSKeyError), and the
+        batch_stats of the batch """
+    started = time.time()
+    states = loader.load_states(oids)
+    extract_started = time.time()
+    results = [(oid, get_oids(states[oid]) if oid in states else None) for oid in oids]
+    extract_seconds = time.time() - extract_started
+    loaded.increment(len(oids))
+    return results, batch_stats(((states[oid], refs) for oid, refs in results if refs is not None),
+                                extract_started - started, extract_seconds, census)
+
+
+_worker_loader = None
+_worker_loaded = None
+_worker_census = False
+
+
+def _init_worker(storage_factory, loaded, census=False):
+    """ Pool initializer - every worker process opens its own storage connection """
+    global _worker_loader, _worker_loaded, _worker_census
+    _worker_loader = get_loader(storage_factory())
+    _worker_loaded = loaded
+    _worker_census = census
+
+
+def _load_refs_worker(oids):
+    return load_refs(_worker_loader, oids, _worker_loaded, _worker_census)
+
+
+def extract_refs(records, census=False):
+    """ Returns (oid, tid, refs) for each (oid, tid, state) record, and the batch_stats of the records """
+    started = time.time()
+    results = [(oid, tid, get_oids(state)) for oid, tid, state in records]
+    extract_seconds = time.time() - started
+    return results, batch_stats(((state, refs) for (oid, tid, state), (o, t, refs) in zip(records, results)),
+                                0.0, extract_seconds, census)
+
+
+def _extract_refs_worker(records):
+    return extract_refs(records, _worker_census)
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    chunk = list(itertools.islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(itertools.islice(iterator, size))
+
+
+def imap_window(pool, func, iterable, window):
+    """ Ordered pool.imap that takes items from iterable on the calling thread, only as results are consumed, with
+        at most window of them submitted at once - pool.imap drains iterable in a feeder thread without limit """
+    pending = deque()
+    iterator = iter(iterable)
+    while True:
+        while len(pending) < window:
+            try:
+                item = next(iterator)
+            except StopIteration:
+                break
+            pending.append(pool.apply_async(func, (item,)))
+        if not pending:
+            return
+        yield pending.popleft().get()
+
+
+class OidSet(object):
+    """ Compact set of u64 oids, roaring-bitmap style: the high bits of an oid select a container holding its
+        low 16 bits - a sorted array('H') while sparse, replaced by an 8KB bitmap once it outgrows ARRAY_LIMIT.
+        Dense ZODB oid ranges cost about one bit per object instead of ~80 bytes for a set of 8-byte strings """
+    ARRAY_LIMIT = 4096  # Past this many entries the bitmap is the smaller container
+
+    def __init__(self, zoids=()):
+        self._containers = {}
+        self._len = 0
+        for zoid in zoids:
+            self.add(zoid)
+
+    def __len__(self):
+        return self._len
+
+    def __contains__(self, zoid):
+        container = self._containers.get(zoid >> 16)
+        if container is None:
+            return False
+        low = zoid & 0xffff
+        if isinstance(container, bytearray):
+            return bool(container[low >> 3] & (1 << (low & 7)))
+        i = bisect_left(container, low)
+        return i < len(container) and container[i] == low
+
+    def __iter__(self):
+        for key in sorted(self._containers):
+            container, high = self._containers[key], key << 16
+            if isinstance(container, bytearray):
+                for byte in xrange(len(container)):
+                    if container[byte]:
+                        for bit in xrange(8):
+                            if container[byte] & (1 << bit):
+                                yield high | (byte << 3) | bit
+            else:
+                for low in container:
+                    yield high | low
+
+    def add(self, zoid):
+        key, low = zoid >> 16, zoid & 0xffff
+        container = self._containers.get(key)
+        if container is None:
+            self._containers[key] = array('H', [low])
+        elif isinstance(container, bytearray):
+            if container[low >> 3] & (1 << (low & 7)):
+                return
+            container[low >> 3] |= 1 << (low & 7)
+        else:
+            i = bisect_left(container, low)
+            if i < len(container) and container[i] == low:
+                return
+            container.insert(i, low)
+            if len(container) > self.ARRAY_LIMIT:
+                bitmap = bytearray(8192)
+                for value in container:
+                    bitmap[value >> 3] |= 1 << (value & 7)
+                self._containers[key] = bitmap
+        self._len += 1
+
+
+class OidMap(object):
+    """ Compact u64 -> u64 map laid out like OidSet: a sparse container is a sorted array('H') of low bits
+        with a parallel array('L') of values, a dense one a 65536-slot array('L') indexed by the low bits """
+    ARRAY_LIMIT = 4096  # Keeps the memmove of a sorted insert into the sparse arrays short
+    MISSING = 0xffffffffffffffff  # Marks empty slots of a dense container
+
+    def __init__(self):
+        self._containers = {}
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    def __contains__(self, zoid):
+        return self.get(zoid) is not None
+
+    def get(self, zoid, default=None):
+        container = self._containers.get(zoid >> 16)
+        if container is None:
+            return default
+        low = zoid & 0xffff
+        if isinstance(container, array):
+            value = container[low]
+            return default if value == self.MISSING else value
+        lows, values = container
+        i = bisect_left(lows, low)
+        if i < len(lows) and lows[i] == low:
+            return values[i]
+        return default
+
+    def __setitem__(self, zoid, value):
+        key, low = zoid >> 16, zoid & 0xffff
+        container = self._containers.get(key)
+        if container is None:
+            self._containers[key] = (array('H', [low]), array('L', [value]))
+        elif isinstance(container, array):
+            if container[low] != self.MISSING:
+                self._len -= 1
+            container[low] = value
+        else:
+            lows, values = container
+            i = bisect_left(lows, low)
+            if i < len(lows) and lows[i] == low:
+                values[i] = value
+                return
+            lows.insert(i, low)
+            values.insert(i, value)
+            if len(lows) > self.ARRAY_LIMIT:
+                dense = array('L', [self.MISSING]) * 65536
+                for j, entry in enumerate(lows):
+                    dense[entry] = values[j]
+                self._containers[key] = dense
+        self._len += 1
+
+
+class ReferenceGraph(object):
+    """ Compact (CSR) reference graph built from records arriving in oid order: zoids holds the u64 oid of
+        every object and targets[offsets[i]:offsets[i + 1]] the u64 oids that object i refers to. max_tid is
+        the newest transaction id (u64) of any record read into the graph. """
+    MAGIC = 'ZSGRAPH1'
+    HEADER = struct.Struct('=QQQ')  # max tid, objects, references
+
+    def __init__(self):
+        self.zoids = array('L')
+        self.offsets = array('L', [0])
+        self.targets = array('L')
+        self.max_tid = 0
+
+    def __len__(self):
+        return len(self.zoids)
+
+    def add(self, oid, refs):
+        # Cross-database references (tuples) can't dangle within this database
+        self.append(u64(oid), (u64(ref) for ref in refs if isinstance(ref, str)))
+
+    def append(self, zoid, targets):
+        if self.zoids and zoid <= self.zoids[-1]:
+            raise ValueError("Records must be added in ascending oid order")
+        self.zoids.append(zoid)
+        self.targets.extend(targets)
+        self.offsets.append(len(self.targets))
+
+    def save(self, filename):
+        """ Writes the graph to filename (atomically replacing any previous one) """
+        with open(filename + '.tmp', 'wb') as f:
+            f.write(self.MAGIC)
+            f.write(self.HEADER.pack(self.max_tid, len(self.zoids), len(self.targets)))
+            for values in (self.zoids, self.offsets, self.targets):
+                values.tofile(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(filename + '.tmp', filename)
+
+    @classmethod
+    def load(cls, filename):
+        """ Reads a graph written by save(), or returns None if there is no usable one """
+        if not os.path.exists(filename):
+            return None
+        graph = cls()
+        with open(filename, 'rb') as f:
+            if f.read(len(cls.MAGIC)) != cls.MAGIC:
+                return None
+            try:
+                graph.max_tid, objects, references = cls.HEADER.unpack(f.read(cls.HEADER.size))
+                graph.offsets = array('L')
+                for values, count in ((graph.zoids, objects), (graph.offsets, objects + 1),
+                                      (graph.targets, references)):
+                    values.fromfile(f, count)
+            except (struct.error, EOFError):
+                return None
+        return graph
+
+    def index(self, zoid):
+        i = bisect_left(self.zoids, zoid)
+        if i < len(self.zoids) and self.zoids[i] == zoid:
+            return i
+        return None
+
+    def walk(self, root):
+        """ Breadth-first walk from the root oid. Returns the number of reachable objects, the parent index of
+            each reached object (-1 otherwise) and a list of (parent index, missing zoid) dangling references """
+        parents = array('l', [-1]) * len(self.zoids)
+        reached = bytearray(len(self.zoids))
+        dangling = []
+        start = self.index(u64(root))
+        if start is None:
+            return 0, parents, dangling
+        reached[start] = 1
+        count = 1
+        frontier = deque([start])
+        while frontier:
+            i = frontier.popleft()
+            for target in set(self.targets[self.offsets[i]:self.offsets[i + 1]]):
+                j = self.index(target)
+                if j is None:
+                    dangling.append((i, target))
+                elif not reached[j]:
+                    reached[j] = 1
+                    parents[j] = i
+                    count += 1
+                    frontier.append(j)
+        return count, parents, dangling
+
+    def ancestors(self, parents, i):
+        """ Rebuilds the oid path of object i, from just below the root down to i itself """
+        path = []
+        while parents[i] != -1:
+            path.append(p64(self.zoids[i]))
+            i = parents[i]
+        return tuple(reversed(path))
+
+
+class ScanCheckpoint(object):
+    """ Checkpoint of a verify() walk under --tmpdir, in two files. The log is append-only: each record holds
+        the (oid, parent) pairs loaded since the previous one. The frontier file holds the frontier and the
+        counters as of the latest record, and is replaced atomically (written aside, then renamed) every time.
+        A log record only counts once its trailer is written and fsync'ed, and records past the one the frontier
+        file was written for are dropped, so a scan killed at any point resumes from a consistent checkpoint. """
+    MAGIC = 'ZSCKPT02'
+    HEADER = struct.Struct('=4sQQ')  # tag, record number, new objects
+    FRONTIER = struct.Struct('=QQQQQ')  # record number, current level, next level, issues, loaded
+    TRAILER = 'END!'
+
+    def __init__(self, filename, objects=0, seconds=0):
+        self.filename = filename
+        self.frontier_filename = filename + '.frontier'
+        self._objects = objects
+        self._seconds = seconds
+        self._last_loaded = 0
+        self._last_time = time.time()
+        self._records = 0
+
+    def enabled(self):
+        return bool(self._objects or self._seconds)
+
+    def due(self, loaded):
+        """ True once either the object count or the wall-clock interval since the last record is reached """
+        if self._objects and loaded - self._last_loaded >= self._objects:
+            return True
+        return bool(self._seconds) and time.time() - self._last_time >= self._seconds
+
+    def write(self, new_zoids, new_parents, curstack, curreferrers, stack, referrers, issues, loaded):
+        record = self._records + 1
+        new_file = not os.path.exists(self.filename)
+        with open(self.filename, 'ab') as f:
+            if new_file:
+                f.write(self.MAGIC)
+            f.write(self.HEADER.pack('CKPT', record, len(new_zoids)))
+            new_zoids.tofile(f)
+            new_parents.tofile(f)
+            f.write(self.TRAILER)
+            f.flush()
+            os.fsync(f.fileno())
+        temporary = self.frontier_filename + '.tmp'
+        with open(temporary, 'wb') as f:
+            f.write(self.MAGIC)
+            f.write(self.FRONTIER.pack(record, len(curstack), len(stack), issues, loaded))
+            for values in (curstack, curreferrers, stack, referrers):
+                values.tofile(f)
+            f.write(self.TRAILER)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(temporary, self.frontier_filename)
+        self._records = record
+        self._last_loaded = loaded
+        self._last_time = time.time()
+
+    def load_frontier(self):
+        """ Returns (record, curstack, curreferrers, stack, referrers, issues, loaded) from the frontier file,
+            or None if there is no complete one """
+        if not os.path.exists(self.frontier_filename):
+            return None
+        with open(self.frontier_filename, 'rb') as f:
+            if f.read(len(self.MAGIC)) != self.MAGIC:
+                return None
+            try:
+                record, current, following, issues, loaded = self.FRONTIER.unpack(f.read(self.FRONTIER.size))
+                values = []
+                for count in (current, current, following, following):
+                    values.append(array('L'))
+                    values[-1].fromfile(f, count)
+            except (struct.error, EOFError):
+                return None
+            if f.read(len(self.TRAILER)) != self.TRAILER:
+                return None
+        return (record,) + tuple(values) + (issues, loaded)
+
+    def load(self):
+        """ Replays the log up to the record of the frontier file, returning (seen, parents, curstack,
+            curreferrers, stack, referrers, issues, loaded), or None if there is no usable checkpoint. Log
+            records past that one (or torn) are cut off. """
+        frontier = self.load_frontier()
+        if frontier is None or not os.path.exists(self.filename):
+            return None
+        last = frontier[0]
+        seen, parents, record = OidSet(), OidMap(), 0
+        with open(self.filename, 'r+b') as f:
+            if f.read(len(self.MAGIC)) != self.MAGIC:
+                return None
+            good = f.tell()
+            while record < last:
+                try:
+                    tag, record, new = self.HEADER.unpack(f.read(self.HEADER.size))
+                    new_zoids, new_parents = array('L'), array('L')
+                    new_zoids.fromfile(f, new)
+                    new_parents.fromfile(f, new)
+                    if tag != 'CKPT' or f.read(len(self.TRAILER)) != self.TRAILER:
+                        break
+                except (struct.error, EOFError):
+                    break
+                for zoid, parent in itertools.izip(new_zoids, new_parents):
+                    seen.add(zoid)
+                    if parent != OidMap.MISSING:
+                        parents[zoid] = parent
+                good = f.tell()
+            if record != last:
+                return None
+            f.truncate(good)
+        self._records = last
+        self._last_loaded = frontier[-1]
+        return (seen, parents) + frontier[1:]
+
+    def remove(self):
+        for filename in (self.filename, self.frontier_filename):
+            if os.path.exists(filename):
+                os.remove(filename)
+        self._records = 0
+
+
+class ClassCensus(object):
+    """ Per-class object counts, pickle sizes and fan-out (references per object) gathered during a scan """
+    FIELDS = ('class', 'objects', 'total_bytes', 'percent_of_bytes', 'mean_bytes', 'p50_bytes', 'p90_bytes',
+              'p99_bytes', 'max_bytes', 'references', 'mean_fanout', 'max_fanout')
+
+    def __init__(self):
+        self.classes = {}
+
+    def add(self, classes):
+        for name, (objects, size, largest, refs, most_refs, sizes) in classes.iteritems():
+            tally = self.classes.get(name)
+            if tally is None:
+                self.classes[name] = [objects, size, largest, refs, most_refs, list(sizes)]
+                continue
+            tally[0] += objects
+            tally[1] += size
+            tally[2] = max(tally[2], largest)
+            tally[3] += refs
+            tally[4] = max(tally[4], most_refs)
+            for bucket, count in enumerate(sizes):
+                tally[5][bucket] += count
+
+    @staticmethod
+    def percentile(sizes, objects, largest, fraction):
+        """ Upper bound of the pickle size below which the given fraction of objects fall (from the
+            power-of-two histogram, so at most twice the exact value - and never above the largest) """
+        wanted, seen = fraction * objects, 0
+        for bucket, count in enumerate(sizes):
+            seen += count
+            if count and seen >= wanted:
+                return min((1 << bucket) - 1, largest)
+        return largest
+
+    def rows(self):
+        """ Returns one dict per class, largest total size first """
+        all_bytes = sum(tally[1] for tally in self.classes.itervalues()) or 1
+        rows = []
+        for name, (objects, size, largest, refs, most_refs, sizes) in self.classes.iteritems():
+            rows.append({
+                'class': name or '<unknown>',
+                'objects': objects,
+                'total_bytes': size,
+                'percent_of_bytes': round(100.0 * size / all_bytes, 2),
+                'mean_bytes': size // objects,
+                'p50_bytes': self.percentile(sizes, objects, largest, 0.50),
+                'p90_bytes': self.percentile(sizes, objects, largest, 0.90),
+                'p99_bytes': self.percentile(sizes, objects, largest, 0.99),
+                'max_bytes': largest,
+                'references': refs,
+                'mean_fanout': round(float(refs) / objects, 2),
+                'max_fanout': most_refs,
+            })
+        rows.sort(key=lambda row: row['total_bytes'], reverse=True)
+        return rows
+
+    def write(self, filename):
+        """ Writes the census as JSON if filename ends with .json, CSV otherwise """
+        rows = self.rows()
+        with open(filename, 'wb') as f:
+            if filename.endswith('.json'):
+                json.dump(rows, f, indent=2, sort_keys=True)
+            else:
+                writer = csv.DictWriter(f, self.FIELDS)
+                writer.writerow(dict(zip(self.FIELDS, self.FIELDS)))
+                writer.writerows(rows)
+
+
+class ScanStats(object):
+    """ Per-phase timing and throughput of a scan. Phases are timed exclusively (a nested phase pauses the
+        enclosing one): 'load' and 'extract' are summed from the batches (whichever process ran them), 'wait' is
+        time the scan spent blocked on the next batch, 'walk' bookkeeping of the seen set, frontier or graph and
+        'report' analysis of dangling references. A 'wait' well above 'load' + 'extract' points at the
+        database (or at too few workers), a large 'extract' or 'walk' at the CPU. """
+    PHASES = ('load', 'extract', 'wait', 'walk', 'report')
+
+    def __init__(self, window=60, interval=60, census=False):
+        self.started = time.time()
+        self.census = ClassCensus() if census else None
+        self.seconds = dict((phase, 0.0) for phase in self.PHASES)
+        self.objects = 0
+        self.bytes = 0
+        self.sizes = [0] * 64
+        self._window = window
+        self._interval = interval
+        self._samples = deque([(self.started, 0, 0)])
+        self._running = []
+        self._last_log = self.started
+
+    @contextmanager
+    def timer(self, phase):
+        now = time.time()
+        if self._running:
+            self.seconds[self._running[-1][0]] += now - self._running[-1][1]
+        self._running.append([phase, now])
+        try:
+            yield
+        finally:
+            now = time.time()
+            phase, started = self._running.pop()
+            self.seconds[phase] += now - started
+            if self._running:
+                self._running[-1][1] = now
+
+    def add_batch(self, batch, within=None):
+        """ Records a batch's stats. within names the phase the batch was run inside of (in this process),
+            which must not count the batch's load and extract time a second time """
+        if within is not None:
+            spent = batch['load'] + batch['extract']
+            if self._running and self._running[-1][0] == within:
+                self._running[-1][1] += spent
+            else:
+                self.seconds[within] -= spent
+        if self.census is not None:
+            self.census.add(batch['classes'])
+        self.objects += batch['objects']
+        self.bytes += batch['bytes']
+        self.seconds['load'] += batch['load']
+        self.seconds['extract'] += batch['extract']
+        for bucket, count in enumerate(batch['sizes']):
+            self.sizes[bucket] += count
+        now = time.time()
+        self._samples.append((now, self.objects, self.bytes))
+        while len(self._samples) > 2 and self._samples[1][0] < now - self._window:
+            self._samples.popleft()
+
+    def rates(self):
+        """ Returns (objects/sec, bytes/sec) over the rolling window """
+        (first, objects, size), (last, all_objects, all_size) = self._samples[0], self._samples[-1]
+        if last <= first:
+            return 0.0, 0.0
+        return (all_objects - objects) / (last - first), (all_size - size) / (last - first)
+
+    def summary(self):
+        objects_rate, bytes_rate = self.rates()
+        return "%d objects, %1.1f MB (%1.1f objects/s, %1.2f MB/s over the last %ds); %s" % \
+               (self.objects, self.bytes / 1048576.0, objects_rate, bytes_rate / 1048576.0, self._window,
+                ", ".join("%s %1.1fs" % (phase, self.seconds[phase]) for phase in self.PHASES))
+
+    def log_periodically(self, log):
+        if self._interval and time.time() - self._last_log >= self._interval:
+            self._last_log = time.time()
+            log.info("Scan statistics: %s", self.summary())
+
+    def as_dict(self):
+        elapsed = time.time() - self.started
+        objects_rate, bytes_rate = self.rates()
+        return {
+            'elapsed_seconds': elapsed,
+            'objects': self.objects,
+            'bytes': self.bytes,
+            'objects_per_second': self.objects / elapsed if elapsed else 0.0,
+            'bytes_per_second': self.bytes / elapsed if elapsed else 0.0,
+            'recent_objects_per_second': objects_rate,
+            'recent_bytes_per_second': bytes_rate,
+            'phase_seconds': self.seconds,
+            # Number of pickles smaller than each power of two (and at least the previous one) in bytes
+            'pickle_size_histogram': dict((str(1 << bucket), count) for bucket, count in enumerate(self.sizes)
+                                          if count),
+        }
+
+
 class PKEReporter(object):
-    def __init__(self, db='zodb'):
+    REPORT_CACHE_SIZE = 10000  # Parent objects whose analysis is kept while reporting
+
+
+    def __init__(self, db='zodb', workers=1, storage_factory=None, loaded=None, stats=None):
         self._dbname = db
-        self._config = get_config(db)
-        self._storage = self._config.storages[0].open()
+        self._workers = workers
+        self.stats = stats or ScanStats()
+        # Number of objects loaded so far - may be shared with a parent process reporting progress
+        self._loaded = loaded or ZenToolboxUtils.Counter(0)
+        # storage_factory opens a new storage connection (used again by every worker process)
+        self._storage_factory = storage_factory or functools.partial(open_storage, db)
+        self._storage = self._storage_factory()
+        self._loader = get_loader(self._storage)
         self._db = DB(self._storage)
         self._conn = self._db.open()
         self._app = self._conn.root()
         self._size = self.get_total_count()
+        # Dangling references found so far, reported in one pass by report_pending()
+        self._pending = []
+        # parent oid -> {child oid: (name, class)} and parent oid -> (class, primary path) or None
+        self._analyses = LRUCache(self.REPORT_CACHE_SIZE)
+        self._paths = LRUCache(self.REPORT_CACHE_SIZE)
 
     def get_total_count(self):
+        if not hasattr(self._storage, '_adapter'):
+            return long(len(self._storage))
         connmanager = self._storage._adapter.connmanager
         conn, cursor = connmanager.open()
         try:
@@ -141,20 +885,31 @@ class PKEReporter(object):
         finally:
             connmanager.close(conn, cursor)
 
-    def analyze(self, parent_oid, child_oid):
-        parent_state = self._storage.load(parent_oid)[0]
-        pickler = Analyzer(parent_state, child_oid)
+    @staticmethod
+    def analyze_state(parent_state):
+        """ Returns {child oid: (name, class)} for the persistent references in a parent's pickle, with the
+            attribute name under which each child is held (None if not held directly by an attribute) """
+        pickler = Analyzer(parent_state)
         pickler.load()
         result = pickler.load()
-        name = None
-        # First try to get the name from the pickle state
+        children = dict((oid, (None, klass)) for oid, klass in pickler.klasses.iteritems())
         try:
             for k, v in result.iteritems():
-                if v is pickler._marker:
-                    name = k
-                    break
+                marker, oid = pickler.markers.get(id(v), (None, None))
+                if marker is v and children[oid][0] is None:
+                    children[oid] = (k, children[oid][1])
         except Exception:
             pass
+        return children
+
+    def analyze(self, parent_oid, child_oid, parent_state=None):
+        children = self._analyses.get(parent_oid)
+        if children is None:
+            if parent_state is None:
+                parent_state = self._storage.load(parent_oid)[0]
+            children = self._analyses[parent_oid] = self.analyze_state(parent_state)
+        # First try to get the name from the pickle state
+        name, klass = children.get(child_oid, (None, None))
         if not name:
             # Now load up the child and see if it has an id
             try:
@@ -178,7 +933,7 @@ class PKEReporter(object):
                         pass
             except AttributeError:  # catch these errors -  AttributeError: 'BTrees.OIBTree.OIBTree' object has no attribute '__dict__'
                 pass
-        return name, pickler.klass
+        return name, klass
 
     @staticmethod
     def oid_versions(oid):
@@ -187,22 +942,63 @@ class PKEReporter(object):
         repred = repr(oid)
         return u64ed, oid_0xstyle, repred
 
-    def report(self, oid, ancestors, log):
+    def report(self, oid, ancestors):
+        """ Records a dangling reference to oid reached through ancestors (ending with oid itself) - it is
+            logged by the next report_pending() """
+        self._pending.append((oid, ancestors))
+
+    def report_pending(self, log):
+        """ Logs every recorded dangling reference. Reports are grouped by parent and, batch by batch, the
+            parents are fetched through the connection together and the states to analyze loaded together - the
+            parent's, and only for a parent without a primary path those of the ancestors above it - so each
+            parent is unpickled only once. """
+        pending, self._pending = self._pending, []
+        pending.sort(key=lambda (oid, ancestors): ancestors)
+        with self.stats.timer('report'):
+            for reports in chunked(pending, BATCH_SIZE):
+                parents = set(ancestors[-2] for oid, ancestors in reports)
+                self.prefetch([parent for parent in parents if parent not in self._paths])
+                wanted = set(parent for parent in parents if parent not in self._analyses)
+                for oid, ancestors in reports:
+                    if not self.primary_path(ancestors[-2]):
+                        wanted.update(a for a in ancestors[:-2] if a not in self._analyses)
+                states = self._loader.load_states(sorted(wanted)) if wanted else {}
+                for oid, ancestors in reports:
+                    self.log_report(oid, ancestors, log, states)
+
+    def prefetch(self, oids):
+        """ Loads the objects at oids into the connection in one round trip, where ZODB supports it """
+        if oids and hasattr(self._conn, 'prefetch'):
+            try:
+                self._conn.prefetch(oids)
+            except Exception:
+                pass
+
+    def primary_path(self, parent_oid):
+        """ Returns (class, primary path) of a PrimaryPathObjectManager parent, None for any other object """
+        if parent_oid not in self._paths:
+            try:
+                immediate_parent = self._conn[parent_oid]
+                self._paths[parent_oid] = (immediate_parent.__class__, immediate_parent.getPrimaryPath())
+            except Exception:
+                self._paths[parent_oid] = None
+        return self._paths.get(parent_oid)
+
+    def log_report(self, oid, ancestors, log, states):
         parent_oid = ancestors[-2]
         parent_klass = None
-        try:
-            immediate_parent = self._conn[parent_oid]
-            parent_klass = immediate_parent.__class__
-            path = immediate_parent.getPrimaryPath()
-        except Exception:
+        primary = self.primary_path(parent_oid)
+        if primary:
+            parent_klass, path = primary
+        else:
             # Not a PrimaryPathObjectManager, do it manually
             path = ['']
             for (a, b) in zip(ancestors[:-2], ancestors[1:-1]):
-                name, klass = self.analyze(a, b)
+                name, klass = self.analyze(a, b, states.get(a))
                 path.append(name)
             parent_klass = klass
         path = filter(None, path)
-        name, klass = self.analyze(*ancestors[-2:])
+        name, klass = self.analyze(parent_oid, oid, states.get(parent_oid))
         par_u64, par_0x, par_rep = self.oid_versions(parent_oid)
         oid_u64, oid_0x, oid_rep = self.oid_versions(oid)
         log.critical(""" DANGLING REFERENCE (POSKeyError) FOUND:
@@ -217,51 +1013,137 @@ Refers to a missing object:
            par_u64=par_u64, par_0x=par_0x, par_rep=par_rep,
            oid_u64=oid_u64, oid_0x=oid_0x, oid_rep=oid_rep))
 
-    def verify(self, root, log, number_of_issues):
+    @staticmethod
+    def ancestors(parents, referrer, oid):
+        """ Rebuilds the oid path (below the root) of oid as reached from referrer, following parent pointers """
+        if referrer == OidMap.MISSING:
+            return ()
+        path = [oid]
+        zoid = referrer
+        while zoid is not None:
+            path.append(p64(zoid))
+            zoid = parents.get(zoid)
+        path.pop()  # The root itself isn't part of the path
+        return tuple(reversed(path))
+
+    def progress(self, chunk_number, number_of_issues):
+        if number_of_issues.value() > 1:
+            inline_print("[%s]  CRITICAL  [%-50s] %3d%% [%d Dangling References]" %
+                         (time.strftime("%Y-%m-%d %H:%M:%S"), '='*chunk_number, 2*chunk_number, number_of_issues.value()))
+        elif number_of_issues.value() == 1:
+            inline_print("[%s]  CRITICAL  [%-50s] %3d%% [%d Dangling Reference]" %
+                         (time.strftime("%Y-%m-%d %H:%M:%S"), '='*chunk_number, 2*chunk_number, number_of_issues.value()))
+        else:
+            inline_print("[%s]  Scanning  [%-50s] %3d%% " % (time.strftime("%Y-%m-%d %H:%M:%S"), '='*chunk_number, 2*chunk_number))
+
+    def load_batches(self, batches, pool=None):
+        """ Yields the load_refs() results for each batch of oids, in order, using the pool if given (with two
+            batches per worker in flight, so batches are only taken - and filtered against seen - when needed) """
+        if pool:
+            return imap_window(pool, _load_refs_worker, batches, 2 * self._workers)
+        census = self.stats.census is not None
+        return itertools.imap(lambda oids: load_refs(self._loader, oids, self._loaded, census), batches)
+
+    def results(self, batches, log, inline=False):
+        """ Yields the results of each (results, batch_stats) pair, recording the stats and the waiting time
+            (less the batch's own load and extract time if inline, i.e. if it was run in this process) """
+        batches = iter(batches)
+        while True:
+            with self.stats.timer('wait'):
+                try:
+                    results, batch = next(batches)
+                except StopIteration:
+                    return
+            self.stats.add_batch(batch, 'wait' if inline else None)
+            self.stats.log_periodically(log)
+            yield results
+
+    def verify(self, root, log, number_of_issues, pool=None, checkpoint=None, resume=False):
 
         database_size = self._size
-        scanned_count = 0
         progress_bar_chunk_size = 1
+        last_chunk_number = 0
 
         if (database_size > 50):
             progress_bar_chunk_size = (database_size//50) + 1
 
         inline_print("[%s]  Scanning  [%-50s] %3d%% " % (time.strftime("%Y-%m-%d %H:%M:%S"), '='*0, 0))
 
-        seen = set()
-        path = ()
-        stack = deque([(root, path)])
-        curstack, stack = stack, deque([])
-        while curstack or stack:
-            oid, path = curstack.pop()
-            scanned_count = len(seen)
-
-            if (scanned_count % progress_bar_chunk_size) == 0:
-                chunk_number = scanned_count // progress_bar_chunk_size
-                if number_of_issues.value() > 2:
-                    inline_print("[%s]  CRITICAL  [%-50s] %3d%% [%d Dangling References]" %
-                                 (time.strftime("%Y-%m-%d %H:%M:%S"), '='*chunk_number, 2*chunk_number, number_of_issues.value()))
-                elif number_of_issues.value() == 1:
-                    inline_print("[%s]  CRITICAL  [%-50s] %3d%% [%d Dangling Reference]" %
-                                 (time.strftime("%Y-%m-%d %H:%M:%S"), '='*chunk_number, 2*chunk_number, number_of_issues.value()))
-                else:
-                    inline_print("[%s]  Scanning  [%-50s] %3d%% " % (time.strftime("%Y-%m-%d %H:%M:%S"), '='*chunk_number, 2*chunk_number))
+        seen = OidSet()
+        # Only the parent of each loaded object is kept; ancestor paths are rebuilt when reporting
+        parents = OidMap()
+        # The frontier is a packed array of u64 oids, with the oid of the referring object alongside
+        curstack, curreferrers = array('L'), array('L')
+        stack, referrers = array('L', [u64(root)]), array('L', [OidMap.MISSING])
+        # Objects loaded since the last checkpoint, with their parents
+        new_zoids, new_parents = array('L'), array('L')
 
-            if (oid not in seen):
-                try:
-                    state = self._storage.load(oid)[0]
-                    seen.add(oid)
-                except POSKeyError:
-                    self.report(oid, path, log)
-                    number_of_issues.increment()
-                else:
-                    refs = get_refs(state)
-                    stack.extend((o, path + (o,)) for o in set(refs) - seen)
+        if resume:
+            state = checkpoint.load()
+            if state:
+                seen, parents, curstack, curreferrers, stack, referrers, issues, loaded = state
+                number_of_issues.increment(issues)
+                self._loaded.increment(loaded - self._loaded.value())
+                log.info("Resuming scan from checkpoint %s (%d objects verified, %d dangling references)",
+                         checkpoint.filename, len(seen), issues)
+            else:
+                log.info("No usable checkpoint at %s - scanning from the root", checkpoint.filename)
+                checkpoint.remove()
+        elif checkpoint:
+            # Records of an earlier, abandoned run must not be replayed if this one is resumed
+            checkpoint.remove()
 
+        while curstack or stack:
+            # Each BFS level is popped in LIFO order and split into batches; objects are loaded (possibly
+            # by the worker pool) batch by batch, but results are consumed in exactly the serial order
             if not curstack:
-                curstack = stack
-                stack = deque([])
+                curstack, curreferrers = stack, referrers
+                stack, referrers = array('L'), array('L')
+            batches = [(max(end - BATCH_SIZE, 0), end) for end in xrange(len(curstack), 0, -BATCH_SIZE)]
+
+            def unseen_oids():
+                for start, end in batches:
+                    yield [p64(zoid) for zoid in set(curstack[start:end]) if zoid not in seen]
+
+            loaded_batches = self.results(self.load_batches(unseen_oids(), pool), log, pool is None)
+            for (start, end), results in itertools.izip(batches, loaded_batches):
+                with self.stats.timer('walk'):
+                    states = dict(results)
+                    for i in xrange(end - 1, start - 1, -1):
+                        zoid = curstack[i]
+                        if zoid in seen:
+                            continue
+                        oid = p64(zoid)
+                        refs = states[oid]
+                        if refs is None:
+                            self.report(oid, self.ancestors(parents, curreferrers[i], oid))
+                            number_of_issues.increment()
+                        else:
+                            seen.add(zoid)
+                            new_zoids.append(zoid)
+                            new_parents.append(curreferrers[i])
+                            if curreferrers[i] != OidMap.MISSING:
+                                parents[zoid] = curreferrers[i]
+                            for o in set(o for o in set(refs) if u64(o) not in seen):
+                                stack.append(u64(o))
+                                referrers.append(zoid)
+
+                chunk_number = min(self._loaded.value() // progress_bar_chunk_size, 50)
+                if chunk_number != last_chunk_number:
+                    last_chunk_number = chunk_number
+                    self.progress(chunk_number, number_of_issues)
+
+                if checkpoint and checkpoint.enabled() and checkpoint.due(self._loaded.value()):
+                    # Issues counted in the checkpoint must have been logged, as a resumed scan won't find them again
+                    self.report_pending(log)
+                    checkpoint.write(new_zoids, new_parents, curstack[:start], curreferrers[:start],
+                                     stack, referrers, number_of_issues.value(), self._loaded.value())
+                    log.debug("Checkpoint written to %s (%d objects verified)", checkpoint.filename, len(seen))
+                    new_zoids, new_parents = array('L'), array('L')
 
+            curstack, curreferrers = array('L'), array('L')
+
+        self.report_pending(log)
         if number_of_issues.value() > 0:
             inline_print("[%s]  CRITICAL  [%-50s] %3.0d%% [%d Dangling References]\n" %
                          (time.strftime("%Y-%m-%d %H:%M:%S"), '='*50, 100, number_of_issues.value()))
@@ -270,15 +1152,137 @@ Refers to a missing object:
 
         return number_of_issues, len(seen), self._size
 
-    def run(self, log, number_of_issues):
+    def read_graph(self, previous, log, pool=None):
+        """ Builds the ReferenceGraph of the database. Without a previous graph every row is read; otherwise only
+            rows with a newer tid are read and the references of all other objects still present are taken
+            from the previous graph """
+        progress_bar_chunk_size = 1
+        last_chunk_number = 0
+
+        if (self._size > 50):
+            progress_bar_chunk_size = (self._size//50) + 1
+
+        inline_print("[%s]  Reading   [%-50s] %3d%% " % (time.strftime("%Y-%m-%d %H:%M:%S"), '='*0, 0))
+
+        graph = ReferenceGraph()
+        records = chunked(self._loader.iter_states(previous.max_tid if previous else None), BATCH_SIZE)
+        census = self.stats.census is not None
+        if pool:
+            extracted = self.results(imap_window(pool, _extract_refs_worker, records, 2 * self._workers), log)
+        else:
+            extracted = self.results(itertools.imap(lambda batch: extract_refs(batch, census), records), log, True)
+
+        if previous:
+            changed = {}
+            for results in extracted:
+                with self.stats.timer('walk'):
+                    for oid, tid, refs in results:
+                        changed[u64(oid)] = array('L', (u64(ref) for ref in refs if isinstance(ref, str)))
+                        graph.max_tid = max(graph.max_tid, u64(tid))
+            graph.max_tid = max(graph.max_tid, previous.max_tid)
+            log.info("%d objects in %s changed since the last scan", len(changed), self._dbname)
+            zoids = chunked(self._loader.iter_zoids(), BATCH_SIZE)
+        else:
+            zoids = extracted
+
+        # Merge-join the current oids against the previous graph; objects missing from both the previous graph
+        # and the changed rows were committed while reading and are loaded individually
+        j = 0
+        for results in zoids:
+            with self.stats.timer('walk'):
+                if previous is None:
+                    for oid, tid, refs in results:
+                        graph.add(oid, refs)
+                        graph.max_tid = max(graph.max_tid, u64(tid))
+                else:
+                    for zoid in results:
+                        while j < len(previous) and previous.zoids[j] < zoid:
+                            j += 1
+                        if zoid in changed:
+                            graph.append(zoid, changed.pop(zoid))
+                        elif j < len(previous) and previous.zoids[j] == zoid:
+                            graph.append(zoid, previous.targets[previous.offsets[j]:previous.offsets[j + 1]])
+                        else:
+                            late, batch = load_refs(self._loader, [p64(zoid)], self._loaded, census)
+                            self.stats.add_batch(batch, 'walk')
+                            for oid, refs in late:
+                                if refs is not None:
+                                    graph.add(oid, refs)
+            self._loaded.increment(len(results))
+            chunk_number = min(self._loaded.value() // progress_bar_chunk_size, 50)
+            if chunk_number != last_chunk_number:
+                last_chunk_number = chunk_number
+                inline_print("[%s]  Reading   [%-50s] %3d%% " %
+                             (time.strftime("%Y-%m-%d %H:%M:%S"), '='*chunk_number, 2*chunk_number))
+        log.info("Read %d objects with %d references from %s", len(graph), len(graph.targets), self._dbname)
+        return graph
+
+    def verify_sequential(self, root, log, number_of_issues, pool=None, graph_file=None, since_last_run=False):
+        """ Streams every stored object in oid order into a ReferenceGraph, then finds reachable objects and
+            dangling references offline instead of loading objects one frontier at a time. With since_last_run
+            only objects changed since the graph saved in graph_file are read again. """
+        previous = None
+        if since_last_run:
+            previous = ReferenceGraph.load(graph_file)
+            if previous:
+                log.info("Rescanning objects changed after tid %d (saved in %s)", previous.max_tid, graph_file)
+            else:
+                log.info("No saved reference graph at %s - reading the whole database", graph_file)
+
+        graph = self.read_graph(previous, log, pool)
+        del previous
+        if graph_file:
+            graph.save(graph_file)
+            log.debug("Saved reference graph to %s", graph_file)
+
+        with self.stats.timer('walk'):
+            reached, parents, dangling = graph.walk(root)
+        for parent, zoid in dangling:
+            oid = p64(zoid)
+            self.report(oid, graph.ancestors(parents, parent) + (oid,))
+            number_of_issues.increment()
+        self.report_pending(log)
+
+        if number_of_issues.value() > 0:
+            inline_print("[%s]  CRITICAL  [%-50s] %3.0d%% [%d Dangling References]\n" %
+                         (time.strftime("%Y-%m-%d %H:%M:%S"), '='*50, 100, number_of_issues.value()))
+        else:
+            inline_print("[%s]  Verified  [%-50s] %3.0d%%\n" % (time.strftime("%Y-%m-%d %H:%M:%S"), '='*50, 100))
+
+        return number_of_issues, reached, len(graph)
+
+    def run(self, log, number_of_issues, sequential=False, checkpoint=None, resume=False,
+            graph_file=None, since_last_run=False):
         print("[%s] Examining %d items in the '%s' database:" %
               (strftime("%Y-%m-%d %H:%M:%S", localtime()), self._size,  self._dbname))
         log.info("Examining %d items in %s database" % (self._size, self._dbname))
 
         oid = '\x00\x00\x00\x00\x00\x00\x00\x01'
 
-        with gc_cache_every(1000, self._db):
-            reported, scanned, total = self.verify(oid, log, number_of_issues)
+        pool = None
+        if self._workers > 1:
+            log.info("Loading objects with %d worker processes", self._workers)
+            pool = multiprocessing.Pool(self._workers, _init_worker,
+                                        (self._storage_factory, self._loaded, self.stats.census is not None))
+
+        try:
+            with gc_cache_every(1000, self._db):
+                if sequential or since_last_run:
+                    reported, scanned, total = self.verify_sequential(oid, log, number_of_issues, pool,
+                                                                      graph_file, since_last_run)
+                    log.info("%d of %d objects in %s are reachable (%3.2f%% unreachable)",
+                             scanned, total, self._dbname, (100.0-100.0*scanned/total) if total else 0.0)
+                else:
+                    reported, scanned, total = self.verify(oid, log, number_of_issues, pool, checkpoint, resume)
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+
+        # The scan completed, so there is nothing left to resume
+        if checkpoint:
+            checkpoint.remove()
+        log.info("Scan statistics for %s: %s", self._dbname, self.stats.summary())
 
         if (100.0*scanned/total) < 90.0:
             print("  ** %3.2f%% of %s objects not reachable - examine your zenossdbpack settings **" %
@@ -288,6 +1292,112 @@ Refers to a missing object:
         print
 
 
+def scan_database(zodb_name, cli_options, log, number_of_issues, loaded=None, total=None):
+    """ Scans one database (the configured zodb-db if zodb_name is None) as selected by the command line """
+    if cli_options['filestorage']:
+        zodb_name = cli_options['filestorage']
+        storage_factory = functools.partial(FileStorage, zodb_name, read_only=True)
+    else:
+        zodb_name = zodb_name or getGlobalConfiguration().get("zodb-db", "zodb")
+        storage_factory = None
+
+    checkpoint = None
+    graph_file = None
+    if cli_options['sequential'] or cli_options['since_last_run']:
+        # The reference graph is kept between runs so that --since-last-run only rereads changed objects
+        graph_file = os.path.join(ZenToolboxUtils.get_state_dir(), "zodbscan_%s.graph" % os.path.basename(zodb_name))
+        if cli_options['resume']:
+            print("--resume is not supported with --sequential or --since-last-run - scanning the whole database")
+    else:
+        checkpoint = ScanCheckpoint(os.path.join(cli_options['tmpdir'], "zodbscan_%s.checkpoint" %
+                                                 os.path.basename(zodb_name)),
+                                    cli_options['checkpoint_objects'], cli_options['checkpoint_seconds'])
+
+    reporter = PKEReporter(zodb_name, cli_options['workers'], storage_factory, loaded,
+                           ScanStats(interval=cli_options['stats_interval'], census=bool(cli_options['census'])))
+    if total:
+        total.increment(reporter._size)
+    reporter.run(log, number_of_issues, cli_options['sequential'], checkpoint, cli_options['resume'],
+                 graph_file, cli_options['since_last_run'])
+    if cli_options['stats_json']:
+        stats = reporter.stats.as_dict()
+        stats['database'] = zodb_name
+        stats['dangling_references'] = number_of_issues.value()
+        with open(cli_options['stats_json'], 'w') as f:
+            json.dump(stats, f, indent=2, sort_keys=True)
+        log.info("Scan statistics written to %s", cli_options['stats_json'])
+    if cli_options['census']:
+        census = reporter.stats.census
+        if cli_options['since_last_run']:
+            log.info("The class census of %s only covers the objects changed since the last scan", zodb_name)
+        census.write(cli_options['census'])
+        for row in census.rows()[:10]:
+            log.info("Census of %s: %s - %d objects, %d bytes (%.2f%%), p99 %d bytes, mean fan-out %.2f",
+                     zodb_name, row['class'], row['objects'], row['total_bytes'], row['percent_of_bytes'],
+                     row['p99_bytes'], row['mean_fanout'])
+        log.info("Class census written to %s", cli_options['census'])
+    log.info("%d Dangling References were detected in %s", number_of_issues.value(), zodb_name)
+
+
+def _scan_database_process(database, cli_options, log, number_of_issues, loaded, total):
+    """ Process target for scan_databases - console output is left to the parent """
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        scan_database(database, cli_options, log, number_of_issues, loaded, total)
+    except Exception as e:
+        log.exception(e)
+        sys.exit(1)
+
+
+def scan_databases(databases, cli_options, log):
+    """ Scans every database at once, each in its own process, merging their progress into one console line.
+        Returns the issue Counter of each database and the list of databases whose scan failed. """
+    print("[%s] Examining the %s databases:" % (strftime("%Y-%m-%d %H:%M:%S", localtime()), ', '.join(databases)))
+    log.info("Scanning databases %s concurrently", ', '.join(databases))
+
+    issues, loaded, totals, processes = {}, {}, {}, []
+    for database in databases:
+        issues[database] = ZenToolboxUtils.Counter(0)
+        loaded[database] = ZenToolboxUtils.Counter(0)
+        totals[database] = ZenToolboxUtils.Counter(0)
+        options = dict(cli_options)
+        if options['stats_json']:
+            # One statistics file per database, e.g. stats_zodb_session.json
+            name, extension = os.path.splitext(options['stats_json'])
+            options['stats_json'] = "%s_%s%s" % (name, database, extension)
+        if options['census']:
+            name, extension = os.path.splitext(options['census'])
+            options['census'] = "%s_%s%s" % (name, database, extension)
+        process = multiprocessing.Process(target=_scan_database_process, name="zodbscan-%s" % database,
+                                          args=(database, options, log, issues[database],
+                                                loaded[database], totals[database]))
+        process.start()
+        processes.append(process)
+
+    while True:
+        running = [process for process in processes if process.is_alive()]
+        scanned = sum(counter.value() for counter in loaded.values())
+        total = sum(counter.value() for counter in totals.values())
+        found = sum(counter.value() for counter in issues.values())
+        chunk_number = min(50 * scanned // total, 50) if total else 0
+        if running:
+            status = "Scanning " if not found else "CRITICAL "
+        else:
+            status = "Verified " if not found else "CRITICAL "
+            chunk_number = 50
+        inline_print("[%s]  %s [%-50s] %3d%% [%d/%d databases done]%s" %
+                     (time.strftime("%Y-%m-%d %H:%M:%S"), status, '='*chunk_number, 2*chunk_number,
+                      len(processes) - len(running), len(processes),
+                      " [%d Dangling References]" % found if found else ""))
+        if not running:
+            break
+        time.sleep(1)
+    print
+
+    failed = [database for database, process in zip(databases, processes) if process.exitcode]
+    return issues, failed
+
+
 def main():
     """Scans through ZODB checking objects for dangling references"""
 
@@ -296,6 +1406,31 @@ def main():
     scriptName = os.path.basename(__file__).split('.')[0]
     parser = ZenToolboxUtils.parse_options(scriptVersion, scriptName + scriptSummary + documentationURL)
     # Add in any specific parser arguments for %scriptName
+    parser.add_argument("-w", "--workers", action="store", default=1, type=int,
+                        help="number of worker processes loading objects (default 1)")
+    parser.add_argument("--filestorage", action="store", default=None,
+                        help="scan a FileStorage (Data.fs) file instead of the configured RelStorage")
+    parser.add_argument("--sequential", action="store_true", default=False,
+                        help="read every object in oid order and check references offline "
+                             "(faster on large databases, needs memory for the reference graph)")
+    parser.add_argument("--since-last-run", action="store_true", default=False,
+                        help="like --sequential, but only reread objects changed since the last "
+                             "--sequential or --since-last-run scan")
+    parser.add_argument("--resume", action="store_true", default=False,
+                        help="continue an interrupted scan from its last checkpoint")
+    parser.add_argument("--checkpoint-objects", action="store", default=1000000, type=int,
+                        help="write a checkpoint every N objects loaded (0 to disable, default 1000000)")
+    parser.add_argument("--checkpoint-seconds", action="store", default=600, type=int,
+                        help="write a checkpoint every N seconds (0 to disable, default 600)")
+    parser.add_argument("--stats-json", action="store", default=None,
+                        help="write per-phase timing and throughput statistics to this JSON file")
+    parser.add_argument("--stats-interval", action="store", default=60, type=int,
+                        help="log scan statistics every N seconds (0 to disable, default 60)")
+    parser.add_argument("--census", action="store", default="",
+                        help="write a per-class census of object counts, pickle sizes and fan-out to FILE "
+                             "(JSON if FILE ends with .json, CSV otherwise)")
+    parser.add_argument("-d", "--databases", action="store", default="",
+                        help="comma-separated databases to scan concurrently (zodb,zodb_session,...)")
     cli_options = vars(parser.parse_args())
     log, logFileName = ZenToolboxUtils.configure_logging(scriptName, scriptVersion, cli_options['tmpdir'])
     log.info("Command line options: %s" % (cli_options))
@@ -309,19 +1444,35 @@ def main():
     if not ZenToolboxUtils.get_lock("zenoss.toolbox", log):
         sys.exit(1)
 
-    number_of_issues = ZenToolboxUtils.Counter(0)
-
-    zodb_name = getGlobalConfiguration().get("zodb-db", "zodb")
+    if cli_options['databases'] and not cli_options['filestorage']:
+        databases = [database.strip() for database in cli_options['databases'].split(',') if database.strip()]
+    else:
+        databases = []
 
-    PKEReporter(zodb_name).run(log, number_of_issues)
-    log.info("%d Dangling References were detected" % (number_of_issues.value()))
+    if len(databases) > 1:
+        issues, failed = scan_databases(databases, cli_options, log)
+        number_of_issues = sum(issues[database].value() for database in databases)
+        for database in databases:
+            print("[%s]   '%s': %s" % (strftime("%Y-%m-%d %H:%M:%S", localtime()), database,
+                                       "scan FAILED (consult log file)" if database in failed else
+                                       "%d Dangling References" % issues[database].value()))
+        print
+    else:
+        counter = ZenToolboxUtils.Counter(0)
+        scan_database(databases[0] if databases else None, cli_options, log, counter)
+        number_of_issues = counter.value()
+        failed = []
+    log.info("%d Dangling References were detected" % (number_of_issues))
 
     print("[%s] Execution finished in %s\n" % (strftime("%Y-%m-%d %H:%M:%S", localtime()),
                                                datetime.timedelta(seconds=int(time.time() - execution_start))))
     log.info("zodbscan completed in %1.2f seconds" % (time.time() - execution_start))
     log.info("############################################################")
 
-    if (number_of_issues.value() > 0):
+    if failed:
+        print("** WARNING ** Unable to scan %s - consult log file\n" % (', '.join(failed)))
+        sys.exit(1)
+    elif (number_of_issues > 0):
         print("** WARNING ** Dangling Reference(s) were detected - Consult KB article at")
         print("      https://support.zenoss.com/hc/en-us/articles/203118175\n")
         sys.exit(1)